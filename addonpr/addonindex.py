@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr addonindex module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines an index of the addons of a repository branch.
+"""
+import os
+import threading
+import multiprocessing
+import logging
+from addonpr import cache, gitrepo
+
+
+logger = logging.getLogger(__name__)
+
+# Indexes already loaded by this process
+_indexes = {}
+_indexes_lock = threading.Lock()
+# Number of addons to parse above which a pool of processes is used
+PARALLEL_PARSE_MIN = 1000
+# Number of addons parsed by each task of the pool
+PARSE_CHUNK_SIZE = 250
+
+
+def get_addon_info(addon):
+    """Return the info of the addon stored in the index
+
+    Return None if the addon.xml is invalid
+    """
+    if addon is None:
+        return None
+    try:
+        return {'id': addon.addon_id,
+                'version': str(addon.version),
+                'type': addon.addon_type,
+                'broken': addon.is_broken(),
+                'dependencies': addon.dependencies}
+    except (TypeError, AttributeError) as e:
+        logger.debug('Invalid addon.xml: %s', e)
+        return None
+
+
+def _parse_chunk(contents):
+    # Imported here as addonparser uses this module
+    from addonpr.addonparser import load_addons
+    return [get_addon_info(addon) for addon in load_addons(contents)]
+
+
+def parse_addons(contents):
+    """Return the list of info of the addons defined by the addon.xml contents
+
+    A pool of processes is used when there are many addons to parse,
+    unless running in a pool process: it can't have children and the
+    callers already run in parallel.
+    """
+    if (len(contents) < PARALLEL_PARSE_MIN or
+            multiprocessing.current_process().daemon):
+        return _parse_chunk(contents)
+    chunks = [contents[i:i + PARSE_CHUNK_SIZE]
+              for i in range(0, len(contents), PARSE_CHUNK_SIZE)]
+    pool = multiprocessing.Pool()
+    try:
+        return [info for infos in pool.map(_parse_chunk, chunks)
+                for info in infos]
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_index(repo_path, branch, result_cache=None):
+    """Return the up to date AddonIndex of the repository branch"""
+    key = (os.path.realpath(repo_path), branch)
+    with _indexes_lock:
+        try:
+            index = _indexes[key]
+        except KeyError:
+            index = _indexes[key] = AddonIndex(repo_path, branch, result_cache)
+        index.update()
+    return index
+
+
+class AddonIndex(object):
+    """Index of the addons of a branch of a local git repository
+
+    Map each addon directory to the addon version, type, broken flag and
+    dependencies. The index is built from the git objects (the branch is
+    not checked out) and updated incrementally when the branch head moves:
+    only the addons whose tree changed are parsed again.
+    The index is saved in the cache if one is given.
+    """
+
+    def __init__(self, repo_path, branch, result_cache=None):
+        self.repo = gitrepo.GitRepo(repo_path)
+        self.branch = branch
+        self.cache = result_cache
+        self.cache_key = cache.make_key('index', os.path.realpath(repo_path),
+                                        branch)
+        self.head = None
+        # {addon dir: addon info (None if the addon.xml is invalid)}
+        self.addons = {}
+        # {addon dir: sha1 of the addon tree}
+        self.trees = {}
+        if self.cache is not None:
+            data = self.cache.get(self.cache_key)
+            if data is not None:
+                self.head = data['head']
+                self.addons = data['addons']
+                self.trees = data['trees']
+
+    def update(self):
+        """Update the index if the branch head moved"""
+        head = self.repo.branch_head(self.branch)
+        if head == self.head:
+            return
+        logger.debug('Updating %s index of %s', self.branch, self.repo.path)
+        trees = dict((name, sha) for mode, obj_type, sha, name
+                     in (self.repo.ls_tree(head) if head else [])
+                     if obj_type == 'tree' and not name.startswith('.'))
+        addons = {}
+        changed = []
+        contents = []
+        cat_file = None
+        try:
+            for name, sha in sorted(trees.items()):
+                if self.trees.get(name) == sha and name in self.addons:
+                    addons[name] = self.addons[name]
+                    continue
+                if cat_file is None:
+                    cat_file = gitrepo.CatFile(self.repo.path)
+                obj = cat_file.get('%s:addon.xml' % sha)
+                changed.append(name)
+                contents.append(obj[1] if obj is not None else None)
+        finally:
+            if cat_file is not None:
+                cat_file.close()
+        addons.update(zip(changed, parse_addons(contents)))
+        self.head = head
+        self.addons = addons
+        self.trees = trees
+        if self.cache is not None:
+            self.cache.set(self.cache_key, {'head': head,
+                                            'addons': addons,
+                                            'trees': trees})
+
+    def get(self, name):
+        """Return the info of the addon in the name directory (None if not found)"""
+        return self.addons.get(name)
@@ -20,20 +20,34 @@ addonpr addonparser module
    <http://www.gnu.org/licenses/>.
 """
 from __future__ import division
+import io
 import os
 import re
+import codecs
+import string
+import hashlib
 import logging
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from xml.parsers.expat import ExpatError
+import xml.etree.cElementTree as cET
 from datetime import datetime, timedelta
-from PIL import Image
-from config import BRANCHES, DEPENDENCIES, STRINGS_ID
-from addonpr import command
+from config import (BRANCHES, DEPENDENCIES, STRINGS_ID, MAX_TEXTURE_SIZE,
+                    SOURCE_RULES)
+from addonpr import command, cache, addonindex, imageinfo, sources, profiler
 
 
 logger = logging.getLogger(__name__)
 
+# XML declaration including the encoding
+XML_ENCODING_RE = re.compile(r'<\?xml\s+version\s*=\s*(["\']).*?\1'
+                             r'\s+encoding\s*=\s*(["\'])(.*?)\2')
+# Names of the strings files of the language dirs
+STRINGS_FILES = ('strings.po', 'strings.xml')
+# Flags of the strings ids bitmap converted to binary digits
+_BITS_TABLE = string.maketrans('\0\1', '01')
+# Modules whose code the checks results depend on
+CHECKS_MODULES = ('addonparser', 'imageinfo', 'sources')
+_checks_hash = None
+
 
 def filter_comments(infile):
     """Generator to filter commented line in a python file"""
@@ -47,32 +61,292 @@ def filter_comments(infile):
             yield line
 
 
+def get_xml_encoding(data):
+    """Return the encoding of the XML declaration of data (None if not given)"""
+    for bom, encoding in ((codecs.BOM_UTF16_LE, 'utf-16-le'),
+                          (codecs.BOM_UTF16_BE, 'utf-16-be')):
+        if data.startswith(bom):
+            # The declaration is at the beginning of the file
+            data = data[len(bom):len(bom) + 400].decode(encoding, 'replace')
+            data = data.encode('utf-8')
+            break
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    match = XML_ENCODING_RE.match(data)
+    if match is None:
+        return None
+    return match.group(3)
+
+
+def get_strings_id_bitmap(ids):
+    """Return the bitmap of the strings ids and the sorted duplicated ids
+
+    Bit n of the bitmap is set for the id STRINGS_ID['all'][0] + n: the
+    ids of several files are compared with integer operations. The ids
+    out of STRINGS_ID['all'] are ignored (check_strings_id reports them).
+    """
+    min_id, max_id = STRINGS_ID['all']
+    flags = bytearray(max_id - min_id + 1)
+    duplicates = set()
+    for string_id in ids:
+        if min_id <= string_id <= max_id:
+            if flags[string_id - min_id]:
+                duplicates.add(string_id)
+            flags[string_id - min_id] = 1
+    bitmap = int(str(flags[::-1]).translate(_BITS_TABLE), 2)
+    return bitmap, sorted(duplicates)
+
+
+def get_bitmap_strings_id(bitmap):
+    """Return the sorted list of the strings ids of bitmap"""
+    min_id = STRINGS_ID['all'][0]
+    return [min_id + n for n, bit in enumerate(reversed(bin(bitmap)[2:]))
+            if bit == '1']
+
+
+def file_check(*suffixes):
+    """Decorator turning a per-file visitor into a check method
+
+    The decorated method is called with a SourceFile for each addon file
+    ending with one of the given suffixes. All file checks are run in a
+    single pass over the addon files (see AddonCheck.scan_files).
+    Calling the check replays the warnings and errors found.
+    """
+    def decorator(visitor):
+        def check(self):
+            self._replay(visitor.__name__)
+        check.__name__ = visitor.__name__
+        check.__doc__ = visitor.__doc__
+        check.visitor = visitor
+        check.suffixes = suffixes
+        return check
+    return decorator
+
+
+class SourceRules(object):
+    """Rules of the python sources checks matched in a single pass
+
+    rules is a list of dictionaries like config.SOURCE_RULES. Only the
+    rules applying to xbmc_branch are kept. Their patterns are combined
+    in a single regex searched in the whole file content: only the lines
+    including a match are split and tested against each rule.
+    """
+
+    def __init__(self, rules, xbmc_branch):
+        self.rules = []
+        for rule in rules:
+            if rule.get('branches') is None or xbmc_branch in rule['branches']:
+                self.rules.append(dict(rule, regex=re.compile(rule['pattern']),
+                                       level=getattr(logging, rule['level'].upper())))
+        if self.rules:
+            self.regex = re.compile('|'.join('(?:%s)' % rule['pattern']
+                                             for rule in self.rules))
+        else:
+            self.regex = None
+
+    def match(self, data):
+        """Return the list of (line, rule) matching in data
+
+        Matches are sorted by line then in the rules order (like testing
+        each rule on each line of filter_comments).
+        """
+        matches = []
+        if self.regex is None:
+            return matches
+        pos = 0
+        while True:
+            match = self.regex.search(data, pos)
+            if match is None:
+                break
+            start = data.rfind('\n', 0, match.start()) + 1
+            end = data.find('\n', match.start())
+            if end < 0:
+                end = len(data)
+            # Only the first match of a line is needed
+            pos = end + 1
+            line = data[start:end].strip()
+            if line.startswith('#'):
+                continue
+            for rule in self.rules:
+                if rule['regex'].search(line):
+                    matches.append((line, rule))
+        return matches
+
+
+class SourceFile(object):
+    """Addon file read at most once and shared between checks"""
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source or sources.DirSource()
+        self._data = None
+        self._lines = None
+        self._tree = None
+        self._parse_error = None
+        self._well_formed = False
+        self._rule_matches = None
+
+    @property
+    def loaded(self):
+        """True if the content of the file was read"""
+        return self._data is not None
+
+    @property
+    def data(self):
+        """Content of the file"""
+        if self._data is None:
+            self._data = self.source.read(self.path)
+        return self._data
+
+    @property
+    def lines(self):
+        """List of the non blank and non commented lines"""
+        if self._lines is None:
+            self._lines = list(filter_comments(io.BytesIO(self.data)))
+        return self._lines
+
+    def match_rules(self, rules):
+        """Return the (line, rule) matching rules (SourceRules)
+
+        The file is searched once for all the checks using the rules.
+        """
+        if self._rule_matches is None:
+            self._rule_matches = rules.match(self.data)
+        return self._rule_matches
+
+    def parse_xml(self):
+        """Return the parsed ElementTree
+
+        Raise ET.ParseError if the file is not valid xml
+        """
+        if self._tree is None and self._parse_error is None:
+            try:
+                self._tree = ET.parse(io.BytesIO(self.data))
+            except ET.ParseError as e:
+                self._parse_error = e
+            except UnicodeError as e:
+                # Raised by the parser on some invalid byte sequences
+                self._parse_error = ET.ParseError(str(e))
+        if self._parse_error is not None:
+            raise self._parse_error
+        return self._tree
+
+    def check_xml(self):
+        """Raise ET.ParseError if the file is not valid xml
+
+        The file is parsed incrementally without keeping the tree (unless
+        it was already parsed by parse_xml).
+        """
+        if (self._tree is None and self._parse_error is None and
+                not self._well_formed):
+            try:
+                for event, element in ET.iterparse(io.BytesIO(self.data)):
+                    element.clear()
+            except ET.ParseError as e:
+                self._parse_error = e
+            except UnicodeError as e:
+                self._parse_error = ET.ParseError(str(e))
+            else:
+                self._well_formed = True
+        if self._parse_error is not None:
+            raise self._parse_error
+
+
 class Addon(object):
-    """Class used to parse the addon.xml"""
-
-    def __init__(self, addon_path):
-        tree = ET.parse(os.path.join(addon_path, 'addon.xml'))
-        self._root = tree.getroot()
-        self.addon_id = self._root.get('id')
-        self.name = self._root.get('name')
-        self.version = AddonVersion(self._root.get('version'))
-        self.provider = self._root.get('provider-name')
-        self.addon_type = None
-        self.dependencies = []
-        self.extensions = []
-        self.metadata = {}
-        self._parse()
-
-    def _parse(self):
-        """Parse the addon.xml"""
-        requires = self._root.find('requires')
-        self.dependencies = [elt.attrib for elt in list(requires)]
-        for ext in self._root.iter('extension'):
+    """Class used to parse the addon.xml
+
+    The addon.xml is read from the given source (the filesystem by default).
+    The id, name, version and provider are read when the Addon is created.
+    The dependencies, extensions and metadata are only parsed when accessed
+    (the type and the broken flag don't need the extensions and metadata
+    to be parsed). The XML tree is dropped once everything is parsed.
+    """
+
+    __slots__ = ('_root', 'addon_id', 'name', 'version', 'provider',
+                 '_dependencies', '_extensions', '_metadata', '_addon_type',
+                 '_broken')
+
+    def __init__(self, addon_path, source=None):
+        source = source or sources.DirSource()
+        with source.open(source.join(addon_path, 'addon.xml')) as f:
+            tree = ET.parse(f)
+        self._init(tree.getroot())
+
+    @classmethod
+    def fromstring(cls, text):
+        """Return the Addon defined by the addon.xml content text"""
+        return cls.fromroot(ET.fromstring(text))
+
+    @classmethod
+    def fromtree(cls, tree):
+        """Return the Addon defined by the addon.xml ElementTree"""
+        return cls.fromroot(tree.getroot())
+
+    @classmethod
+    def fromroot(cls, root):
+        """Return the Addon defined by the addon.xml root element"""
+        addon = cls.__new__(cls)
+        addon._init(root)
+        return addon
+
+    def _init(self, root):
+        self._root = root
+        self.addon_id = root.get('id')
+        self.name = root.get('name')
+        self.version = AddonVersion(root.get('version'))
+        self.provider = root.get('provider-name')
+        self._dependencies = None
+        self._extensions = None
+        self._metadata = None
+        self._addon_type = None
+        self._broken = None
+
+    @property
+    def dependencies(self):
+        """List of the required addons (attributes of the import tags)"""
+        if self._dependencies is None:
+            requires = self._root.find('requires')
+            self._dependencies = [elt.attrib for elt in list(requires)]
+            self._release_root()
+        return self._dependencies
+
+    @property
+    def extensions(self):
+        """List of the extensions (excluding metadata)"""
+        if self._extensions is None:
+            self._parse_extensions()
+        return self._extensions
+
+    @property
+    def metadata(self):
+        """Dictionary of the metadata extension"""
+        if self._metadata is None:
+            self._parse_extensions()
+        return self._metadata
+
+    @property
+    def addon_type(self):
+        if self._addon_type is None:
+            self._addon_type = self._get_addon_type()
+        return self._addon_type
+
+    def _parse_extensions(self):
+        """Parse the extensions and the metadata of the addon.xml"""
+        extensions = []
+        metadata = {}
+        for ext in self._root.findall('extension'):
             if ext.get('point') == 'xbmc.addon.metadata':
-                self.metadata = self._get_metadata(ext)
+                metadata = self._get_metadata(ext)
             else:
-                self.extensions.append(self._get_extension(ext))
-        self.addon_type = self._get_addon_type()
+                extensions.append(self._get_extension(ext))
+        self._extensions = extensions
+        self._metadata = metadata
+        self._release_root()
+
+    def _release_root(self):
+        """Drop the XML tree if all its parts were parsed"""
+        if self._dependencies is not None and self._extensions is not None:
+            self._root = None
 
     def _get_extension(self, ext):
         extension = ext.attrib
@@ -99,8 +373,7 @@ class Addon(object):
 
     def _get_addon_type(self):
         """Return the addon type"""
-        for extension in self.extensions:
-            extension_type = extension['point']
+        for extension_type in self.get_extension_points():
             if extension_type == 'xbmc.gui.skin':
                 return 'skin'
             elif extension_type == 'xbmc.gui.webinterface':
@@ -115,11 +388,24 @@ class Addon(object):
 
     def is_broken(self):
         """Return True if the addon is broken"""
-        return 'broken' in self.metadata
+        if self._broken is None:
+            if self._metadata is None:
+                # Only look for the tag (the metadata are not parsed)
+                metadata = [ext for ext in self._root.findall('extension')
+                            if ext.get('point') == 'xbmc.addon.metadata']
+                self._broken = bool(metadata and
+                                    metadata[-1].find('broken') is not None)
+            else:
+                self._broken = 'broken' in self._metadata
+        return self._broken
 
     def get_extension_points(self):
         """Return a list of extension points (excluding metadata)"""
-        return [extension['point'] for extension in self.extensions]
+        if self._extensions is None:
+            # Only read the points (the extensions are not parsed)
+            return [ext.get('point') for ext in self._root.findall('extension')
+                    if ext.get('point') != 'xbmc.addon.metadata']
+        return [extension['point'] for extension in self._extensions]
 
     def get_extensions(self, point):
         """Return a filtered list of extensions by point-attribute"""
@@ -140,6 +426,8 @@ class Addon(object):
 class AddonVersion(object):
     """Class to represent and compare addon versions"""
 
+    __slots__ = ('version', 'length')
+
     version_re = re.compile(r'^(\d+)\.(\d+)(?:\.(\d+))?$',
                             re.VERBOSE)
 
@@ -160,57 +448,225 @@ class AddonVersion(object):
     def __str__(self):
         return '.'.join(map(str, self.version))
 
+    def __reduce__(self):
+        return (AddonVersion, (str(self),))
+
     def __cmp__(self, other):
         if isinstance(other, basestring):
             other = AddonVersion(other)
         return cmp(self.version, other.version)
 
 
+def get_checks_hash():
+    """Return the sha1 of the code of the modules the checks depend on"""
+    global _checks_hash
+    if _checks_hash is None:
+        checks_hash = hashlib.sha1()
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for module in CHECKS_MODULES:
+            with open(os.path.join(package_dir, module + '.py'), 'rb') as f:
+                checks_hash.update(f.read())
+        _checks_hash = checks_hash.hexdigest()
+    return _checks_hash
+
+
+def load_addons(contents):
+    """Generator returning the Addons defined by the addon.xml contents
+
+    The contents are parsed with cElementTree to load a whole repository
+    quickly (one at a time: the XML trees are not all kept in memory).
+    None is returned for an invalid addon.xml (the errors in the parts
+    parsed on access are raised when accessing them).
+    """
+    for content in contents:
+        try:
+            addon = Addon.fromroot(cET.fromstring(content))
+        except (TypeError, ValueError, SyntaxError, LookupError) as e:
+            # ParseError of cElementTree is a SyntaxError (LookupError
+            # is raised for an unknown encoding)
+            logger.debug('Invalid addon.xml: %s', e)
+            addon = None
+        yield addon
+
+
 class AddonCheck(object):
-    """Class to run addon tests"""
+    """Class to run addon tests
+
+    addon_path can be a directory or a zip archive (checked without
+    being extracted). The files can also be read from another source,
+    like a revision of a git repository (see the sources module).
+    """
+
+    image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tbn',
+                        '.tif', '.tiff', '.tga', '.dds')
+    # Image formats supported and their extensions
+    image_formats = {'png': ('.png',),
+                     'jpeg': ('.jpg', '.jpeg', '.tbn'),
+                     'gif': ('.gif',)}
 
     def __init__(self, addon_path, xbmc_branch, addon_id=None,
-            addon_version=None, parent_dir=None):
+            addon_version=None, parent_dir=None, cache=None,
+            incremental=False, source=None):
         self.addon_id = addon_id
+        self.source = source or sources.get_source(addon_path)
         self.addon_path = self._get_addon_path(addon_path)
         self.xbmc_branch = xbmc_branch
+        self.source_rules = SourceRules(SOURCE_RULES, xbmc_branch)
         self.addon_version = addon_version
         self.parent_dir = parent_dir
         self.files = self._get_files()
-        self.addon = Addon(self.addon_path)
+        self._sources = {}
+        # The parsed addon.xml is shared with the file checks
+        self.addon = Addon.fromtree(self.get_source(
+            self.source.join(self.addon_path, 'addon.xml')).parse_xml())
         self.warnings = 0
         self.errors = 0
+        # Findings of the file checks: {check name: {filename: records}}
+        self._findings = None
+        self._recording = None
+        self.cache = cache
+        self.incremental = incremental
+        # Messages logged by the checks, of all levels (stored in the cache)
+        self._results = None
+        self._file_hashes = {}
+        # Findings of the other checks (kept by run_recorded)
+        self._check_findings = None
+        # Strings ids read by check_strings_id: {filename: list of ids}
+        self._strings_ids = {}
+
+    def _log(self, level, message, *args, **kwargs):
+        if self._recording is not None:
+            # Running a file check: the message will be replayed later
+            self._recording.append((level, message, args, kwargs))
+            return
+        if level == logging.WARNING:
+            self.warnings += 1
+        elif level == logging.ERROR:
+            self.errors += 1
+        if self._results is not None:
+            self._results.append((level, message % args if args else message))
+        logger.log(level, message, *args, **kwargs)
+
+    def _debug(self, message, *args, **kwargs):
+        self._log(logging.DEBUG, message, *args, **kwargs)
 
     def _warning(self, message, *args, **kwargs):
-        self.warnings += 1
-        logger.warning(message, *args, **kwargs)
+        self._log(logging.WARNING, message, *args, **kwargs)
 
     def _error(self, message, *args, **kwargs):
-        self.errors += 1
-        logger.error(message, *args, **kwargs)
+        self._log(logging.ERROR, message, *args, **kwargs)
 
     def _get_files(self):
-        filenames = [os.path.join(root, name)
-            for root, dirs, files in os.walk(self.addon_path)
-            for name in files]
-        return filenames
+        return self.source.walk_files(self.addon_path)
 
     def _get_addon_path(self, addon_path):
-        if self.addon_id and os.path.isdir(os.path.join(addon_path, self.addon_id)):
-            addon_path = os.path.join(addon_path, self.addon_id)
+        if self.addon_id and self.source.isdir(self.source.join(addon_path, self.addon_id)):
+            addon_path = self.source.join(addon_path, self.addon_id)
             logger.debug('Switched to addon subdir: %s', addon_path)
+        elif self.source.is_archive and not self.source.isfile(
+                self.source.join(addon_path, 'addon.xml')):
+            # Archives usually include the addon directory
+            names = self.source.listdir(addon_path)
+            if len(names) == 1 and self.source.isdir(
+                    self.source.join(addon_path, names[0])):
+                addon_path = self.source.join(addon_path, names[0])
+                logger.debug('Switched to addon subdir: %s', addon_path)
         return addon_path
 
-    def _checkout_branch(self, repo):
-        """Checkout the proper branch in repo"""
-        current_dir = os.getcwd()
+    def get_source(self, filename):
+        """Return the SourceFile shared by all checks for filename"""
         try:
-            os.chdir(repo)
-        except OSError as e:
-            logger.error('OSError: %s', e.strerror)
-            return
-        command.run('git checkout -qf %s' % self.xbmc_branch)
-        os.chdir(current_dir)
+            return self._sources[filename]
+        except KeyError:
+            source = self._sources[filename] = SourceFile(filename, self.source)
+            return source
+
+    def _get_file_checks(self):
+        """Return the list of (name, suffixes, visitor) of the file checks"""
+        file_checks = []
+        for attribute in dir(self):
+            if attribute.startswith('check_'):
+                method = getattr(self, attribute)
+                if hasattr(method, 'visitor'):
+                    file_checks.append((attribute, method.suffixes,
+                                        method.visitor))
+        return file_checks
+
+    def scan_files(self):
+        """Run all the file checks in a single pass over the addon files
+
+        Each file is opened at most once and dispatched to every check
+        interested in its extension. Warnings and errors are recorded per
+        check and per file to be replayed in the usual checks order.
+        """
+        file_checks = self._get_file_checks()
+        self._findings = dict((name, {}) for name, _, _ in file_checks)
+        incremental = self.incremental and self.cache is not None
+        if incremental:
+            files_key = self.get_files_cache_key()
+            previous_state = self.cache.get(files_key) or {}
+            state = {}
+        for filename in self.files:
+            if incremental:
+                relpath = os.path.relpath(filename, self.addon_path)
+                entry = previous_state.get(relpath)
+                if entry is not None and entry[0] == self._get_file_hash(filename):
+                    # File unchanged since the previous check
+                    self._restore_file_findings(filename, entry[1])
+                    state[relpath] = entry
+                    self._sources.pop(filename, None)
+                    continue
+            self._scan_file(filename, file_checks)
+            # Only files whose content was checked are worth storing
+            source = self._sources.get(filename)
+            if incremental and source is not None and source.loaded:
+                state[relpath] = [self._get_file_hash(filename),
+                                  self._get_file_findings(filename)]
+            # Content is not needed anymore once all checks are done
+            self._sources.pop(filename, None)
+        if incremental:
+            self.cache.set(files_key, state)
+
+    def _scan_file(self, filename, file_checks):
+        """Run the file checks interested in filename and record their findings"""
+        with profiler.measure('file', filename):
+            for name, suffixes, visitor in file_checks:
+                if filename.endswith(suffixes):
+                    records = self._findings[name][filename] = []
+                    self._recording = records
+                    try:
+                        with profiler.measure('check', name,
+                                              addon=self.addon_path):
+                            visitor(self, self.get_source(filename))
+                    finally:
+                        self._recording = None
+
+    def _get_file_findings(self, filename):
+        """Return the findings of filename with the path replaced by a marker"""
+        findings = {}
+        for name in self._findings:
+            if filename in self._findings[name]:
+                findings[name] = [
+                    (level, (message % args if args else message).replace(filename, '\0'))
+                    for level, message, args, kwargs in self._findings[name][filename]]
+        return findings
+
+    def _restore_file_findings(self, filename, findings):
+        """Restore the findings of filename stored by _get_file_findings"""
+        for name, records in findings.items():
+            if name in self._findings:
+                self._findings[name][filename] = [
+                    (level, message.encode('utf-8').replace('\0', filename), (), {})
+                    for level, message in records]
+
+    def _replay(self, name):
+        """Log the warnings and errors found by the file check name"""
+        if self._findings is None:
+            self.scan_files()
+        findings = self._findings[name]
+        for filename in self.files:
+            for level, message, args, kwargs in findings.get(filename, []):
+                self._log(level, message, *args, **kwargs)
 
     def check_xbmc_version(self):
         if self.xbmc_branch not in BRANCHES:
@@ -240,10 +696,16 @@ class AddonCheck(object):
 
     def check_dependencies(self):
         xbmc_dependencies = DEPENDENCIES[self.xbmc_branch]
+        indexes = []
         if self.parent_dir is not None:
-            # Prepare the repositories for dependencies check
+            # Index of the addons of the branch in the repositories
             for repo in ['plugins', 'scripts']:
-                self._checkout_branch(os.path.join(self.parent_dir, repo))
+                repo_path = os.path.join(self.parent_dir, repo)
+                if os.path.isdir(repo_path):
+                    indexes.append(addonindex.get_index(
+                        repo_path, self.xbmc_branch, self.cache))
+                else:
+                    logger.error('OSError: No such directory: %s', repo_path)
         for dependency in self.addon.dependencies:
             dependency_id = dependency['addon']
             try:
@@ -264,20 +726,20 @@ class AddonCheck(object):
                                 dependency_version)
             elif self.parent_dir is not None:
                 # Try to check plugins and scripts dependencies
-                for repo in ['plugins', 'scripts']:
-                    dependency_dir = os.path.join(self.parent_dir, repo, dependency_id)
-                    if os.path.isdir(dependency_dir):
-                        dependency_addon = Addon(dependency_dir)
-                        if dependency_version > dependency_addon.version:
+                for index in indexes:
+                    dependency_addon = index.get(dependency_id)
+                    if dependency_addon is not None:
+                        addon_version = AddonVersion(dependency_addon['version'])
+                        if dependency_version > addon_version:
                             self._error('Invalid version for %s (%s > %s)',
                                 dependency_id,
                                 dependency_version,
-                                dependency_addon.version)
+                                addon_version)
                         else:
                             logger.debug('%s dependency OK (%s <= %s)',
                                 dependency_id,
                                 dependency_version,
-                                dependency_addon.version)
+                                addon_version)
                         break
                 else:
                     logger.debug('Skipping dependency %s (not found in plugins or scripts)',
@@ -288,25 +750,24 @@ class AddonCheck(object):
 
     def check_addon_structure(self):
         for mandatory in ('addon.xml', 'LICENSE.txt'):
-            if not os.path.isfile(os.path.join(self.addon_path, mandatory)):
+            if not self.source.isfile(self.source.join(self.addon_path, mandatory)):
                 self._error('Missing %s file', mandatory)
         for recommended in ('changelog.txt',):
-            if not os.path.isfile(os.path.join(self.addon_path, recommended)):
+            if not self.source.isfile(self.source.join(self.addon_path, recommended)):
                 self._warning('Missing recommended %s file', recommended)
 
-    def check_forbidden_files(self):
-        for filename in self.files:
-            if filename.endswith(('.so', '.dll', '.pyo', '.pyc',
-                '.exe', '.xbt', '.xpr', 'Thumbs.db', '.DS_Store')):
-                self._error('%s is not allowed', filename)
+    @file_check('.so', '.dll', '.pyo', '.pyc', '.exe', '.xbt', '.xpr',
+                'Thumbs.db', '.DS_Store')
+    def check_forbidden_files(self, source):
+        self._error('%s is not allowed', source.path)
 
     def _get_image_size(self, picture):
         try:
-            img = Image.open(os.path.join(self.addon_path, picture))
+            return imageinfo.get_image_size(
+                self.source.join(self.addon_path, picture), self.source)
         except IOError:
             logger.debug("Picture %s doesn't exist" % picture)
             return (0, 0)
-        return img.size
 
     def check_images(self):
         # module are not visible and don't require any images
@@ -322,46 +783,70 @@ class AddonCheck(object):
                                                                     (1920, 1080)):
                 self._error('Incorrect fanart.jpg aspect ratio: %dx%d', width, height)
 
-    def check_forbidden_patterns(self):
-        for filename in self.files:
-            if filename.endswith('.py'):
-                logger.debug('Checking %s' % filename)
-                with open(filename, 'rb') as f:
-                    for line in filter_comments(f):
-                        if 'os.getcwd' in line:
-                            self._warning('%s: os.getcwd() is deprecated', filename)
-                        if 'PLAYER_CORE' in line:
-                            self._warning('{}: setting PLAYER_CORE_* is deprecated'.format(filename))
-                        if 'executehttpapi' in line:
-                            self._warning('{}: executehttpapi is deprecated'.format(filename))
-
-    def get_po_strings_id(self, filename):
+    def check_image_files(self):
+        images = [filename for filename in self.files
+                  if filename.lower().endswith(self.image_extensions)]
+        for filename, info in zip(images, imageinfo.get_images_info(images, self.source)):
+            if info is None:
+                self._warning('%s: unknown image format', filename)
+                continue
+            image_format, width, height = info
+            if image_format not in self.image_formats:
+                self._warning('%s: %s format is not supported', filename,
+                              image_format)
+            elif not filename.lower().endswith(self.image_formats[image_format]):
+                self._warning('%s: %s image with a wrong extension', filename,
+                              image_format)
+            relpath = os.path.relpath(filename, self.addon_path)
+            if (self.addon.addon_type == 'skin' and
+                    relpath.startswith('media' + os.sep) and
+                    max(width, height) > MAX_TEXTURE_SIZE):
+                self._warning('%s: texture too large (%dx%d)', filename,
+                              width, height)
+
+    def _apply_source_rules(self, source, check):
+        """Log the messages of the source rules of check matching source"""
+        logged = set()
+        for line, rule in source.match_rules(self.source_rules):
+            if rule['check'] != check:
+                continue
+            if rule.get('once'):
+                if rule['pattern'] in logged:
+                    continue
+                logged.add(rule['pattern'])
+            self._log(rule['level'], '%s: %s', source.path, rule['message'])
+            self._debug(line)
+
+    @file_check('.py')
+    def check_forbidden_patterns(self, source):
+        self._debug('Checking %s' % source.path)
+        self._apply_source_rules(source, 'check_forbidden_patterns')
+
+    def get_po_strings_id(self, source):
         """Generator that returns all strings id from a po file"""
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith("msgctxt"):
-                    # msgctxt "#30301"
-                    try:
-                        yield int(line.split()[1][2:-1])
-                    except ValueError:
-                        self._warning('{}: has not integer string ID: {}'.format(filename, line))
+        for line in source.lines:
+            if line.startswith("msgctxt"):
+                # msgctxt "#30301"
+                try:
+                    yield int(line.split()[1][2:-1])
+                except ValueError:
+                    self._warning('{}: has not integer string ID: {}'.format(source.path, line))
 
-    def get_xml_strings_id(self, filename):
+    def get_xml_strings_id(self, source):
         """Generator that returns all strings id from a xml file"""
         try:
-            tree = ET.parse(filename)
+            tree = source.parse_xml()
         except ET.ParseError as e:
-            self._error('Parse error in {}: {}'.format(filename, e))
-            raise StopIteration
+            self._error('Parse error in {}: {}'.format(source.path, e))
+            return
         for elt in tree.getroot():
             yield int(elt.get('id'))
 
-    def get_strings_id(self, filename):
+    def get_strings_id(self, source):
         """Generator that returns all strings id from file"""
-        file_type = filename.split('.')[-1]
+        file_type = source.path.split('.')[-1]
         try:
-            return getattr(self, 'get_{}_strings_id'.format(file_type))(filename)
+            return getattr(self, 'get_{}_strings_id'.format(file_type))(source)
         except AttributeError:
             logger.warning('Unknown strings file type: {}'.format(file_type))
             return []
@@ -374,52 +859,99 @@ class AddonCheck(object):
             min_id, max_id = STRINGS_ID['all']
         return min_id <= string_id <= max_id
 
-    def check_strings_id(self):
-        for filename in self.files:
-            if filename.endswith(('strings.xml', 'strings.po')):
-                logger.debug('Checking %s' % filename)
-                for string_id in self.get_strings_id(filename):
-                    if not self.is_valid_string_id(string_id, 'all'):
-                        self._error('Invalid string id {}'.format(string_id))
-                    elif not self.is_valid_string_id(string_id, self.addon.addon_type):
-                        self._warning('Invalid string id {} for {}'.format(
-                            string_id, self.addon.addon_type))
-
-    def check_xml_encoding(self):
-        for filename in self.files:
-            if filename.endswith('.xml'):
-                try:
-                    dom = minidom.parse(filename)
-                except ExpatError as e:
-                    self._error('{}: {}'.format(filename, e))
-                else:
-                    if not dom.encoding:
-                        self._error('No xml encoding specified in {}'.format(filename))
-                    else:
-                        logger.debug('{} encoding: {}'.format(filename, dom.encoding))
+    @file_check(*STRINGS_FILES)
+    def check_strings_id(self, source):
+        self._debug('Checking %s' % source.path)
+        string_ids = self._strings_ids[source.path] = []
+        for string_id in self.get_strings_id(source):
+            string_ids.append(string_id)
+            if not self.is_valid_string_id(string_id, 'all'):
+                self._error('Invalid string id {}'.format(string_id))
+            elif not self.is_valid_string_id(string_id, self.addon.addon_type):
+                self._warning('Invalid string id {} for {}'.format(
+                    string_id, self.addon.addon_type))
 
-    def check_print_statements(self):
-        print_re = re.compile('print[ \(]')
-        for filename in self.files:
-            if filename.endswith('.py'):
-                if 'test' in filename:
-                    logger.debug('Skipping %s for print-check' % filename)
+    def _get_strings_ids(self, filename):
+        """Return the strings ids of filename (read by check_strings_id)"""
+        try:
+            return self._strings_ids[filename]
+        except KeyError:
+            pass
+        # Findings restored from the cache (incremental mode): the file
+        # wasn't read. Its warnings and errors were already reported.
+        recording = self._recording
+        self._recording = []
+        try:
+            string_ids = list(self.get_strings_id(self.get_source(filename)))
+        finally:
+            self._recording = recording
+            self._sources.pop(filename, None)
+        self._strings_ids[filename] = string_ids
+        return string_ids
+
+    def check_strings_consistency(self):
+        """Compare the strings ids of the languages to the English ones
+
+        Report the ids defined twice in a file and the ids not defined in
+        English. The number of ids not translated is only logged.
+        """
+        language_dir = self.source.join(self.addon_path, 'resources', 'language')
+        if not self.source.isdir(language_dir):
+            return
+        files = set(self.files)
+        bitmaps = {}
+        for dirname in sorted(self.source.listdir(language_dir)):
+            for name in STRINGS_FILES:
+                filename = self.source.join(language_dir, dirname, name)
+                if filename not in files:
                     continue
-                logger.debug('Checking %s' % filename)
-                with open(filename, 'rb') as f:
-                    for line in filter_comments(f):
-                        if print_re.search(line):
-                            self._warning('%s: print statement should be replaced with xbmc.log()', filename)
-                            logger.debug(line)
-                            # We need only one warning per file, so exit the
-                            # loop
-                            break
+                bitmap, duplicates = get_strings_id_bitmap(
+                    self._get_strings_ids(filename))
+                if duplicates:
+                    self._warning('{}: duplicated string id(s) {}'.format(
+                        filename, ', '.join(str(i) for i in duplicates)))
+                bitmaps[dirname] = bitmaps.get(dirname, 0) | bitmap
+        english = bitmaps.get('English')
+        if english is None:
+            return
+        for dirname, bitmap in sorted(bitmaps.items()):
+            orphans = bitmap & ~english
+            if orphans:
+                self._warning('Language {}: string id(s) {} not defined in English'.format(
+                    dirname, ', '.join(str(i) for i in get_bitmap_strings_id(orphans))))
+            missing = english & ~bitmap
+            if missing:
+                self._log(logging.INFO, 'Language {}: {} string(s) not translated'.format(
+                    dirname, bin(missing).count('1')))
+
+    @file_check('.xml')
+    def check_xml_encoding(self, source):
+        filename = source.path
+        try:
+            source.check_xml()
+        except ET.ParseError as e:
+            self._error('{}: {}'.format(filename, e))
+        else:
+            encoding = get_xml_encoding(source.data)
+            if not encoding:
+                self._error('No xml encoding specified in {}'.format(filename))
+            else:
+                self._debug('{} encoding: {}'.format(filename, encoding))
+
+    @file_check('.py')
+    def check_print_statements(self, source):
+        filename = source.path
+        if 'test' in filename:
+            self._debug('Skipping %s for print-check' % filename)
+            return
+        self._debug('Checking %s' % filename)
+        self._apply_source_rules(source, 'check_print_statements')
 
     def check_language_dirs(self):
-        language_dir = os.path.join(self.addon_path, 'resources', 'language')
-        if not os.path.exists(language_dir):
+        language_dir = self.source.join(self.addon_path, 'resources', 'language')
+        if not self.source.isdir(language_dir):
             return
-        for dirname in os.listdir(language_dir):
+        for dirname in self.source.listdir(language_dir):
             logger.debug('Checking language dir {}'.format(dirname))
             # The language dir can be made of several words:
             # Chinese (Traditional)
@@ -437,13 +969,215 @@ class AddonCheck(object):
                 self._error(('Wrong start-attribute for service extension. '
                              'It needs to be either "startup" or "login"'))
 
-    def run(self):
-        """Run all the check methods and return the numbers of warnings and errors"""
-        logger.info('Checking %s', self.addon_path)
+    def _get_file_hash(self, filename):
+        """Return the git blob sha1 of filename (incremental mode)
+
+        The sha1 of the files of a directory are usually known from the
+        cache key. Otherwise the content is loaded in the SourceFile shared
+        with the file checks (read once if they check the file).
+        """
+        try:
+            return self._file_hashes[filename]
+        except KeyError:
+            pass
+        if isinstance(self.source, sources.GitSource):
+            # Known without reading the file
+            file_hash = self._file_hashes[filename] = self.source.blob_sha(filename)
+            return file_hash
+        data = self.get_source(filename).data
+        file_hash = hashlib.sha1('blob %d\0' % len(data))
+        file_hash.update(data)
+        file_hash = self._file_hashes[filename] = file_hash.hexdigest()
+        return file_hash
+
+    def _get_tree_hash(self):
+        """Return a hash of the addon files names and content identifiers
+
+        See the get_file_keys method of the sources. The git blob sha1
+        are kept for the incremental mode.
+        """
+        filenames = sorted(self.files)
+        keys = self.source.get_file_keys(filenames)
+        if not isinstance(self.source, sources.ZipSource):
+            self._file_hashes.update(zip(filenames, keys))
+        tree_hash = hashlib.sha1()
+        for filename, key in zip(filenames, keys):
+            tree_hash.update(os.path.relpath(filename, self.addon_path))
+            tree_hash.update('\0')
+            tree_hash.update(repr(key))
+        return tree_hash.hexdigest()
+
+    def _get_parent_heads(self):
+        """Return the head of xbmc_branch in the parent repositories"""
+        heads = []
+        if self.parent_dir is not None:
+            for repo in ['plugins', 'scripts']:
+                repo_path = os.path.join(self.parent_dir, repo)
+                if os.path.isdir(repo_path):
+                    heads.append(command.run(
+                        'git for-each-ref --format=%(objectname) refs/heads/{}'.format(
+                        self.xbmc_branch), cwd=repo_path))
+        return heads
+
+    def _get_checks_fingerprint(self):
+        """Return a tuple identifying the configuration and the checks code"""
+        check_names = [attribute for attribute in dir(self)
+                       if attribute.startswith('check_')]
+        return (sorted(DEPENDENCIES.items()),
+                sorted(STRINGS_ID.items()),
+                [sorted(rule.items()) for rule in SOURCE_RULES],
+                BRANCHES,
+                check_names,
+                get_checks_hash())
+
+    def get_cache_key(self):
+        """Return the key of the checks results in the cache
+
+        The key depends on the addon files (their git blob sha1, or their
+        size and CRC-32 for a zip archive), the given parameters, the state of the
+        parent repositories (dependencies), the configuration and the
+        checks code.
+        """
+        return cache.make_key(self._get_tree_hash(),
+                              self.xbmc_branch,
+                              self.addon_id,
+                              self.addon_version and str(self.addon_version),
+                              self._get_parent_heads(),
+                              self._get_checks_fingerprint())
+
+    def get_files_cache_key(self):
+        """Return the key of the file checks findings in the cache
+
+        The findings are stored per file with the file hash to be reused
+        when checking another version of the same addon (incremental mode).
+        """
+        return cache.make_key('files',
+                              self.addon.addon_id,
+                              self.addon.addon_type,
+                              self.xbmc_branch,
+                              self._get_checks_fingerprint())
+
+    def _run_checks(self):
+        if self._findings is None:
+            # Measured apart from the first file check
+            with profiler.measure('scan', self.addon_path):
+                self.scan_files()
         for attribute in dir(self):
             if attribute.startswith('check_'):
                 logger.debug('Running %s' % attribute)
-                getattr(self, attribute)()
+                with profiler.measure('check', attribute, addon=self.addon_path):
+                    getattr(self, attribute)()
+
+    def _run_cached_checks(self):
+        """Run the checks or replay the cached results of a previous run"""
+        key = self.get_cache_key()
+        results = self.cache.get(key)
+        if results is None:
+            self._results = []
+            self._run_checks()
+            # The same addon can be checked from another path
+            # (like a directory or an archive)
+            self.cache.set(key, [(level, message.replace(self.addon_path, '\0'))
+                                 for level, message in self._results])
+            self._results = None
+        else:
+            logger.debug('Replaying cached results')
+            for level, message in results:
+                self._log(level, message.encode('utf-8').replace(
+                    '\0', self.addon_path))
+
+    def _run_addon_checks(self):
+        """Run the checks that are not file checks and record their findings"""
+        for attribute in dir(self):
+            if (attribute.startswith('check_') and
+                    not hasattr(getattr(self, attribute), 'visitor')):
+                records = self._check_findings[attribute] = []
+                self._recording = records
+                try:
+                    with profiler.measure('check', attribute,
+                                          addon=self.addon_path):
+                        getattr(self, attribute)()
+                finally:
+                    self._recording = None
+
+    def _replay_all(self):
+        """Log the recorded findings of all the checks"""
+        self.warnings = 0
+        self.errors = 0
+        logger.info('Checking %s', self.addon_path)
+        for attribute in dir(self):
+            if not attribute.startswith('check_'):
+                continue
+            if attribute in self._check_findings:
+                for level, message, args, kwargs in self._check_findings[attribute]:
+                    self._log(level, message, *args, **kwargs)
+            else:
+                self._replay(attribute)
+        logger.info('%d warning(s) and %d error(s) found', self.warnings,
+                self.errors)
+        return (self.warnings, self.errors)
+
+    def run_recorded(self):
+        """Run all the checks keeping the findings to check the addon again
+
+        The cache is not used. Return the numbers of warnings and errors
+        (see recheck).
+        """
+        self._check_findings = {}
+        self.scan_files()
+        self._run_addon_checks()
+        return self._replay_all()
+
+    def recheck(self, paths):
+        """Check the addon again after the given paths changed
+
+        paths are the files (or directories) modified, created or removed
+        since the previous run (run_recorded or recheck). Only the file
+        checks of the changed files are run again (of all the files if the
+        addon.xml changed). The other checks are run again if the addon.xml,
+        an image or a strings file changed or if files were added or
+        removed. Return the numbers of warnings and errors.
+        """
+        old_files = set(self.files)
+        self.files = self._get_files()
+        files = set(self.files)
+        changed = set(paths) & (files | old_files)
+        changed.update(files ^ old_files)
+        addon_xml = self.source.join(self.addon_path, 'addon.xml')
+        if addon_xml in changed:
+            # Some file checks depend on the addon (its type for the strings)
+            changed = files | old_files
+        for filename in changed:
+            self._sources.pop(filename, None)
+            self._strings_ids.pop(filename, None)
+            for findings in self._findings.values():
+                findings.pop(filename, None)
+        if addon_xml in changed:
+            self.addon = Addon.fromtree(self.get_source(addon_xml).parse_xml())
+        file_checks = self._get_file_checks()
+        for filename in self.files:
+            if filename in changed:
+                self._scan_file(filename, file_checks)
+                self._sources.pop(filename, None)
+        if (addon_xml in changed or files != old_files or
+                any(filename.lower().endswith(self.image_extensions) or
+                    filename.endswith(STRINGS_FILES)
+                    for filename in changed)):
+            self._run_addon_checks()
+        return self._replay_all()
+
+    def run(self):
+        """Run all the check methods and return the numbers of warnings and errors
+
+        If a cache is given, the results of a previous run on the same
+        addon are replayed instead of running the checks.
+        """
+        logger.info('Checking %s', self.addon_path)
+        with profiler.measure('addon', self.addon_path):
+            if self.cache is None:
+                self._run_checks()
+            else:
+                self._run_cached_checks()
         logger.info('%d warning(s) and %d error(s) found', self.warnings,
                 self.errors)
         return (self.warnings, self.errors)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr cache module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines an on-disk cache used to store the checks results.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import ConfigParser
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = '~/.cache/addon-pr'
+# Default maximum size of the cache in MB
+DEFAULT_MAX_SIZE = 50
+
+
+def get_cache(config, clear=False):
+    """Return the ResultCache defined in the [cache] section of config
+
+    Return None if the cache is disabled (max_size = 0)
+    """
+    try:
+        path = config.get('cache', 'dir')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        path = DEFAULT_DIR
+    try:
+        max_size = config.getint('cache', 'max_size')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        max_size = DEFAULT_MAX_SIZE
+    if max_size <= 0:
+        return None
+    cache = ResultCache(os.path.expanduser(path), max_size * 1024 * 1024)
+    if clear:
+        cache.clear()
+    return cache
+
+
+def make_key(*items):
+    """Return a key computed from the given items"""
+    return hashlib.sha1(repr(items)).hexdigest()
+
+
+class ResultCache(object):
+    """Cache storing json serializable values on disk
+
+    Each entry is stored in its own file. The least recently used entries
+    are removed when the total size exceeds max_size bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        """Return the value stored for key (None if not cached)"""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = json.load(f)
+        except (IOError, ValueError):
+            return None
+        try:
+            # Mark the entry as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        logger.debug('Cache hit %s', key)
+        return value
+
+    def set(self, key, value):
+        """Store value for key"""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                logger.warning('Cannot create cache directory: %s', e.strerror)
+                return
+        try:
+            data = json.dumps(value)
+        except (TypeError, ValueError, UnicodeDecodeError) as e:
+            logger.debug('Cannot cache %s: %s', key, e)
+            return
+        # Write in a temporary file and rename it so that concurrent
+        # readers never see a partial entry
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_name, self._filename(key))
+        self.evict()
+
+    def _entries(self):
+        """Return the list of (mtime, size, filename) of the entries"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries exceeding max_size"""
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        for mtime, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """Remove all the entries"""
+        if not os.path.isdir(self.path):
+            return
+        logger.info('Clearing cache %s', self.path)
+        for _, _, filename in self._entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -25,26 +25,71 @@ import sys
 import shlex
 import shutil
 import subprocess
+import tarfile
+import threading
+import time
 import urllib
-import zipfile
 import logging
+from addonpr import profiler
 
 
 logger = logging.getLogger(__name__)
 
+# Lock protecting the working trees of the local git repositories
+# (checks and commits of pull requests can run in different threads)
+git_lock = threading.RLock()
 
-def run(cmd):
-    """Run the shell command and return the result"""
+
+def run(cmd, cwd=None, env=None, input=None, ignore_errors=False):
+    """Run the shell command and return the result
+
+    The command is run in the cwd directory if given, with the env
+    variables added to the environment. input is sent to its stdin.
+    Exit on error unless ignore_errors is True.
+    """
     cmd = cmd.encode('utf-8')
     logger.debug('Run %s', cmd)
     args = shlex.split(cmd)
-    try:
-        result = subprocess.check_output(args)
-    except subprocess.CalledProcessError as e:
-        sys.stderr.write(e.output)
-        sys.exit(e.returncode)
-    else:
-        return result.strip()
+    if env is not None:
+        env = dict(os.environ, **env)
+    start = time.time()
+    process = subprocess.Popen(args, cwd=cwd, env=env,
+            stdin=None if input is None else subprocess.PIPE,
+            stdout=subprocess.PIPE)
+    result = process.communicate(input)[0]
+    profiler.count_subprocess(cmd, time.time() - start)
+    if process.returncode and not ignore_errors:
+        sys.stderr.write(result)
+        sys.exit(process.returncode)
+    return result.strip()
+
+
+def succeeds(cmd, cwd=None):
+    """Run the shell command and return True if it succeeded
+
+    The output is discarded
+    """
+    cmd = cmd.encode('utf-8')
+    logger.debug('Run %s', cmd)
+    start = time.time()
+    with open(os.devnull, 'wb') as devnull:
+        returncode = subprocess.call(shlex.split(cmd), cwd=cwd, stdout=devnull,
+                                     stderr=devnull)
+    profiler.count_subprocess(cmd, time.time() - start)
+    return returncode == 0
+
+
+def dir_size(path):
+    """Return the total size in bytes of the files under path"""
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path)
+               for name in files)
+
+
+def log_fetch(url, start, size):
+    """Log the time and the number of bytes received to fetch url"""
+    logger.info('Fetched %s in %.1fs (%d KB received)', url,
+                time.time() - start, size // 1024)
 
 
 def silent_remove(filenames):
@@ -57,28 +102,98 @@ def silent_remove(filenames):
 
 
 def git_pull(addon, url, revision):
-    current_dir = os.getcwd()
-    run('git clone -q "%s" %s' % (url, addon))
-    os.chdir(addon)
-    run('git checkout -q "%s"' % revision)
-    shutil.rmtree('.git')
-    silent_remove(['.gitignore', '.gitattributes'])
-    os.chdir(current_dir)
+    """Fetch only the given revision (sha1, tag or branch) of url in addon
+
+    A shallow fetch of the revision is tried first. Servers can refuse it
+    for a sha1 that isn't advertised: a partial clone (without blobs) is
+    done instead, only the blobs of the revision being downloaded at
+    checkout. Servers without partial clone support send everything.
+    """
+    start = time.time()
+    run('git init -q %s' % addon)
+    run('git remote add origin "%s"' % url, cwd=addon)
+    if succeeds('git fetch -q --depth 1 origin "%s"' % (revision or 'HEAD'),
+                cwd=addon):
+        run('git checkout -q FETCH_HEAD', cwd=addon)
+    else:
+        logger.debug('Shallow fetch of %s refused. Trying a partial clone.',
+                     revision)
+        if not succeeds('git fetch -q --tags --filter=blob:none origin',
+                        cwd=addon):
+            # git older than 2.19
+            run('git fetch -q --tags origin', cwd=addon)
+        run('git checkout -q "%s"' % revision, cwd=addon)
+    log_fetch(url, start, dir_size(os.path.join(addon, '.git', 'objects')))
+    shutil.rmtree(os.path.join(addon, '.git'))
+    silent_remove([os.path.join(addon, '.gitignore'),
+                   os.path.join(addon, '.gitattributes')])
+    return addon
 
 
 def svn_pull(addon, url, revision):
     run('svn export "%s" -r "%s" %s' % (url, revision, addon))
+    return addon
+
+
+def _hg_archive_pull(addon, url, revision):
+    """Download and extract in addon the archive of revision (hgweb)
+
+    Return the size of the archive (None if the server doesn't provide it)
+    """
+    archive_url = '%s/archive/%s.tar.gz' % (url.rstrip('/'), revision or 'tip')
+    try:
+        filename = urllib.urlretrieve(archive_url, addon + '.tar.gz')[0]
+    except IOError as e:
+        logger.debug('Cannot download %s: %s', archive_url, e)
+        return None
+    size = os.path.getsize(filename)
+    try:
+        tar_file = tarfile.open(filename)
+        members = []
+        for member in tar_file.getmembers():
+            # Remove the top directory of the archive (<repo>-<node>)
+            name = member.name.split('/', 1)[1:]
+            if (not name or not (member.isfile() or member.isdir()) or
+                    name[0].startswith('/') or '..' in name[0].split('/')):
+                continue
+            member.name = name[0]
+            members.append(member)
+        tar_file.extractall(addon, members)
+        tar_file.close()
+    except tarfile.TarError as e:
+        # Error page: archives are not enabled on the server
+        logger.debug('Invalid archive %s: %s', archive_url, e)
+        shutil.rmtree(addon, ignore_errors=True)
+        return None
+    finally:
+        silent_remove([filename])
+    silent_remove([os.path.join(addon, '.hg_archival.txt')])
+    return size
 
 
 def hg_pull(addon, url, revision):
-    run('hg clone --insecure -r "%s" "%s" %s' % (revision, url, addon))
-    shutil.rmtree(os.path.join(addon, '.hg'))
+    """Fetch only the given revision of url in addon
+
+    Mercurial can't do shallow clones: the archive of the revision is
+    downloaded when the server provides it (hgweb), otherwise the
+    repository is cloned up to the revision.
+    """
+    start = time.time()
+    size = None
+    if url.startswith(('http://', 'https://')):
+        size = _hg_archive_pull(addon, url, revision)
+    if size is None:
+        run('hg clone --insecure -r "%s" "%s" %s' % (revision, url, addon))
+        size = dir_size(os.path.join(addon, '.hg'))
+        shutil.rmtree(os.path.join(addon, '.hg'))
     silent_remove([os.path.join(addon, '.hgignore')])
+    log_fetch(url, start, size)
+    return addon
 
 
 def zip_pull(addon, url, revision):
+    # The archive is checked without being extracted
+    # (see sources.ZipSource)
     addon_zip = addon + '.zip'
     urllib.urlretrieve(url, addon_zip)
-    zip_file = zipfile.ZipFile(addon_zip)
-    zip_file.extractall()
-    os.remove(addon_zip)
+    return addon_zip
@@ -46,3 +46,33 @@ STRINGS_ID = {
     'script': (32000, 32999),
     'all': (30000, 33999),
     }
+# Maximum width or height of the skins textures (media directory)
+MAX_TEXTURE_SIZE = 2048
+# Rules of the python sources checks. The pattern (regex) is searched in
+# each line stripped of its leading and trailing whitespace (commented
+# lines are skipped), so it shall not be anchored nor span several lines.
+# The rule only applies to the given branches (all of them if None). With
+# once, a single message is logged per file.
+SOURCE_RULES = [
+    {'check': 'check_forbidden_patterns',
+     'pattern': r'os\.getcwd',
+     'level': 'warning',
+     'message': 'os.getcwd() is deprecated',
+     'branches': None},
+    {'check': 'check_forbidden_patterns',
+     'pattern': r'PLAYER_CORE',
+     'level': 'warning',
+     'message': 'setting PLAYER_CORE_* is deprecated',
+     'branches': None},
+    {'check': 'check_forbidden_patterns',
+     'pattern': r'executehttpapi',
+     'level': 'warning',
+     'message': 'executehttpapi is deprecated',
+     'branches': None},
+    {'check': 'check_print_statements',
+     'pattern': r'print[ \(]',
+     'level': 'warning',
+     'message': 'print statement should be replaced with xbmc.log()',
+     'branches': None,
+     'once': True},
+    ]
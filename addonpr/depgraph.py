@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr depgraph module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines the dependency graph of all the addons of a branch
+(in the plugins, scripts, scrapers and skins repositories).
+"""
+import os
+import logging
+from config import DEPENDENCIES
+from addonpr import addonindex
+from addonpr.addonparser import AddonVersion
+
+
+logger = logging.getLogger(__name__)
+
+# Repositories of the addons in the git parent dir
+REPOSITORIES = ['plugins', 'scripts', 'scrapers', 'skins']
+
+
+def find_cycles(edges):
+    """Return the list of cycles of the graph (sorted list of nodes)
+
+    edges maps each node to the list of its successors. The cycles are
+    the strongly connected components of more than one node (or with a
+    loop), found with an iterative version of Tarjan's algorithm.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    for root in sorted(edges):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        # Nodes being visited with the iterator of their successors
+        work = [(root, iter(edges[root]))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges.get(successor, ()))))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                # All the successors of node were visited
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in edges.get(node, ()):
+                        cycles.append(sorted(component))
+    return cycles
+
+
+class DependencyGraph(object):
+    """Dependency graph of the addons of a branch
+
+    The addons are read from the indexes of the repositories (see
+    addonindex): branches are not checked out and only the addons that
+    changed since the previous run are parsed.
+    """
+
+    def __init__(self, xbmc_branch):
+        self.xbmc_branch = xbmc_branch
+        # {addon id: addon info of the index with its path}
+        self.addons = {}
+        # {addon id: list of the ids of the addons it depends on}
+        self.edges = {}
+        self.warnings = 0
+        self.errors = 0
+
+    def _warning(self, message, *args):
+        self.warnings += 1
+        logger.warning(message, *args)
+
+    def _error(self, message, *args):
+        self.errors += 1
+        logger.error(message, *args)
+
+    def add_repository(self, repo_path, result_cache=None):
+        """Add the addons of the branch of the repository"""
+        index = addonindex.get_index(repo_path, self.xbmc_branch, result_cache)
+        repo = os.path.basename(repo_path)
+        for name, info in sorted(index.addons.items()):
+            path = '%s/%s' % (repo, name)
+            if info is None:
+                self._warning('%s: invalid addon.xml', path)
+            elif info['id'] in self.addons:
+                self._warning('%s: %s already defined in %s', path, info['id'],
+                              self.addons[info['id']]['path'])
+            else:
+                self.addons[info['id']] = dict(info, path=path)
+
+    def _check_dependency(self, addon_id, dependency):
+        """Check one dependency and return the id of the addon it requires
+
+        Return None if the dependency is not an addon of the graph
+        """
+        dependency_id = dependency.get('addon')
+        dependency_version = dependency.get('version')
+        xbmc_dependencies = DEPENDENCIES[self.xbmc_branch]
+        if dependency_id in xbmc_dependencies:
+            if (dependency_version is not None and
+                    dependency_version != xbmc_dependencies[dependency_id]):
+                self._error('%s: invalid version for %s (%s != %s)', addon_id,
+                            dependency_id, dependency_version,
+                            xbmc_dependencies[dependency_id])
+            return None
+        required = self.addons.get(dependency_id)
+        if required is None:
+            if dependency.get('optional') == 'true':
+                logger.debug('%s: optional dependency %s not found', addon_id,
+                             dependency_id)
+            else:
+                self._warning('%s: unresolved dependency %s', addon_id,
+                              dependency_id)
+            return None
+        if dependency_version is not None:
+            try:
+                if AddonVersion(dependency_version) > AddonVersion(required['version']):
+                    self._error('%s: invalid version for %s (%s > %s)',
+                                addon_id, dependency_id, dependency_version,
+                                required['version'])
+            except ValueError as e:
+                self._error('%s: dependency %s: %s', addon_id, dependency_id, e)
+        if required['broken']:
+            self._warning('%s: depends on the broken addon %s', addon_id,
+                          dependency_id)
+        return dependency_id
+
+    def check(self):
+        """Check the dependencies of all the addons
+
+        Report the unresolved dependencies, the versions not satisfied, the
+        dependencies on broken addons and the cycles. Return the numbers of
+        warnings and errors.
+        """
+        for addon_id in sorted(self.addons):
+            edges = self.edges[addon_id] = []
+            for dependency in self.addons[addon_id]['dependencies']:
+                dependency_id = self._check_dependency(addon_id, dependency)
+                if dependency_id is not None:
+                    edges.append(dependency_id)
+        for cycle in find_cycles(self.edges):
+            self._error('Dependency cycle between %s', ', '.join(cycle))
+        logger.info('%d addons checked: %d warning(s) and %d error(s) found',
+                    len(self.addons), self.warnings, self.errors)
+        return (self.warnings, self.errors)
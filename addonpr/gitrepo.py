@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr gitrepo module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines classes to work on the local git repositories
+using plumbing commands (without checking out branches).
+"""
+import os
+import stat
+import shutil
+import subprocess
+import tempfile
+import threading
+import logging
+from addonpr import command
+
+
+logger = logging.getLogger(__name__)
+
+
+def hash_blobs(filenames):
+    """Return the git blob sha1 of the files (no repository is needed)
+
+    The contents are hashed as is (without the attributes filters).
+    """
+    if not filenames:
+        return []
+    return command.run('git hash-object --no-filters --stdin-paths',
+                       input='\n'.join(filenames)).split()
+
+
+class GitRepo(object):
+    """Local git repository"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def git(self, args, **kwargs):
+        """Run the git command in the repository and return the result"""
+        return command.run('git ' + args, cwd=self.path, **kwargs)
+
+    def rev_parse(self, ref):
+        """Return the sha1 of ref"""
+        return self.git('rev-parse -q --verify %s' % ref)
+
+    def branch_head(self, branch):
+        """Return the sha1 of the branch head (empty string if it doesn't exist)"""
+        return self.git('for-each-ref --format=%%(objectname) refs/heads/%s' % branch)
+
+    def ls_tree(self, treeish, recursive=False):
+        """Return the list of (mode, type, sha1, name) in treeish
+
+        The entries of the subtrees are included if recursive is True
+        """
+        entries = []
+        args = '-r -z' if recursive else '-z'
+        for line in self.git('ls-tree %s %s' % (args, treeish)).split('\0'):
+            if line:
+                info, name = line.split('\t', 1)
+                mode, obj_type, sha = info.split()
+                entries.append((mode, obj_type, sha, name))
+        return entries
+
+    def last_commit_dates(self, ref, paths, pathspec='*/addon.xml'):
+        """Return {path: timestamp of the last commit of ref modifying path}
+
+        The dates are computed in one pass of git log limited to pathspec.
+        git log is stopped once all the paths are found.
+        """
+        wanted = set(paths)
+        dates = {}
+        if not wanted:
+            return dates
+        process = subprocess.Popen(['git', 'log', '--format=%x00%ct',
+                                    '--name-only', ref, '--', pathspec],
+                                   cwd=self.path, stdout=subprocess.PIPE)
+        timestamp = None
+        try:
+            for line in process.stdout:
+                line = line.rstrip('\n')
+                if line.startswith('\0'):
+                    timestamp = int(line[1:])
+                elif line in wanted and line not in dates:
+                    dates[line] = timestamp
+                    if len(dates) == len(wanted):
+                        break
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        return dates
+
+    def current_branch(self):
+        """Return the checked out branch (HEAD if detached)"""
+        return self.git('rev-parse --abbrev-ref HEAD')
+
+    def has_path(self, commit, path):
+        """Return True if path exists in commit"""
+        return bool(self.git('ls-tree --name-only %s -- %s' % (commit, path)))
+
+    def hash_files(self, filenames, write=True):
+        """Return the sha1 of the files (written in the object database)
+
+        Objects already in the database are not written again.
+        """
+        if not filenames:
+            return []
+        return self.git('hash-object %s--stdin-paths' % ('-w ' if write else ''),
+                        input='\n'.join(filenames)).split()
+
+    def get_tree_entries(self, commit, path):
+        """Return {path in repo: (mode, sha1)} of the files under path in commit
+
+        Return an empty dictionary if path doesn't exist in commit.
+        """
+        if not self.has_path(commit, path):
+            return {}
+        return dict((os.path.join(path, name), (mode, sha))
+                    for mode, obj_type, sha, name in self.ls_tree(
+                        '%s:%s' % (commit, path), recursive=True))
+
+    def get_dir_entries(self, commit, path, source_dir):
+        """Return the list of (mode, filename, path in repo) in source_dir
+
+        source_dir is meant to be committed as path on top of commit. The
+        files ignored by the .gitignore files are skipped (see ignored).
+        """
+        entries = []
+        for root, dirs, files in os.walk(source_dir):
+            # os.walk doesn't follow symlinks to directories
+            names = files + [name for name in dirs
+                             if os.path.islink(os.path.join(root, name))]
+            for name in names:
+                filename = os.path.join(root, name)
+                mode = os.lstat(filename).st_mode
+                if stat.S_ISLNK(mode):
+                    mode = '120000'
+                elif mode & stat.S_IXUSR:
+                    mode = '100755'
+                else:
+                    mode = '100644'
+                repo_path = os.path.join(path, os.path.relpath(filename, source_dir))
+                entries.append((mode, filename, repo_path))
+        ignored = self.ignored(commit, path, entries)
+        return [entry for entry in entries if entry[2] not in ignored]
+
+    def diff_dir(self, commit, path, source_dir, write=True):
+        """Compare source_dir to the content of path in commit
+
+        Return (changed, removed): the list of (mode, sha1, filename, path
+        in repo) of the files added or modified and the list of the paths
+        in repo of the files removed. Files are compared by their blob
+        sha1 and mode (the new blobs are written if write is True).
+        """
+        entries = self.get_dir_entries(commit, path, source_dir)
+        files = [filename for mode, filename, _ in entries if mode != '120000']
+        shas = dict(zip(files, self.hash_files(files, write)))
+        for mode, filename, _ in entries:
+            if mode == '120000':
+                shas[filename] = self.git('hash-object %s--stdin' % (
+                    '-w ' if write else ''), input=os.readlink(filename))
+        committed = self.get_tree_entries(commit, path)
+        changed = [(mode, shas[filename], filename, repo_path)
+                   for mode, filename, repo_path in entries
+                   if committed.get(repo_path) != (mode, shas[filename])]
+        new_paths = set(repo_path for _, _, repo_path in entries)
+        removed = sorted(repo_path for repo_path in committed
+                         if repo_path not in new_paths)
+        return changed, removed
+
+    def update_dir(self, path, source_dir):
+        """Update path in the working tree and the index from source_dir
+
+        Only the files added, modified or removed compared to HEAD are
+        moved from source_dir, removed and staged: the working tree shall
+        be clean. The files ignored by the .gitignore files are skipped.
+        """
+        changed, removed = self.diff_dir('HEAD', path, source_dir, write=False)
+        logger.debug('%s: %d file(s) changed, %d removed', path, len(changed),
+                     len(removed))
+        for repo_path in removed:
+            filename = os.path.join(self.path, repo_path)
+            command.silent_remove([filename])
+            # Remove the directories left empty (like git rm)
+            dirname = os.path.dirname(filename)
+            while dirname != self.path:
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    break
+                dirname = os.path.dirname(dirname)
+        for mode, sha, filename, repo_path in changed:
+            dest = os.path.join(self.path, repo_path)
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                os.remove(dest)
+            elif not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.move(filename, dest)
+        paths = [repo_path for _, _, _, repo_path in changed] + removed
+        if paths:
+            self.git('update-index --add --remove -z --stdin',
+                     input='\0'.join(paths))
+
+    def ignored(self, commit, path, entries):
+        """Return the set of the paths in repo of entries that are ignored
+
+        entries are the (mode, filename, path in repo) of the files to
+        commit as path on top of commit. The .gitignore files are read
+        from the directories of commit above path and from the entries,
+        not from the working tree (the branch of commit may not be checked
+        out). check-ignore is run in a temporary work tree made of these
+        .gitignore files only.
+        """
+        if not entries:
+            return set()
+        parts = path.split('/')
+        parent_files = ['/'.join(parts[:i] + ['.gitignore'])
+                        for i in range(len(parts))]
+        work_tree = tempfile.mkdtemp(prefix='addon-pr-ignore-')
+        try:
+            gitignores = [(self.git('cat-file blob %s' % sha), repo_path)
+                          for mode, obj_type, sha, repo_path in self.ls_tree(
+                              '%s -- %s' % (commit, ' '.join(parent_files)))]
+            gitignores.extend((None, repo_path) for _, _, repo_path in entries
+                              if os.path.basename(repo_path) == '.gitignore')
+            sources = dict((repo_path, filename)
+                           for _, filename, repo_path in entries)
+            for data, repo_path in gitignores:
+                dest = os.path.join(work_tree, repo_path)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                if data is None:
+                    shutil.copyfile(sources[repo_path], dest)
+                else:
+                    with open(dest, 'wb') as f:
+                        f.write(data + '\n')
+            git_dir = os.path.join(self.path, self.git('rev-parse --git-dir'))
+            # check-ignore exits with 1 when no path is ignored
+            return set(command.run(
+                'git --git-dir=%s --work-tree=%s check-ignore --no-index '
+                '--stdin' % (git_dir, work_tree), cwd=work_tree,
+                input='\n'.join(repo_path for _, _, repo_path in entries),
+                ignore_errors=True).splitlines())
+        finally:
+            shutil.rmtree(work_tree, ignore_errors=True)
+
+
+class CatFile(object):
+    """Read objects of a repository with a persistent git cat-file process"""
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                         cwd=repo_path,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+
+    def get(self, obj):
+        """Return the (type, content) of obj (None if it doesn't exist)
+
+        obj can be any object name like <commit>:<path>
+        """
+        with self._lock:
+            self._process.stdin.write(obj + '\n')
+            self._process.stdin.flush()
+            header = self._process.stdout.readline().split()
+            if len(header) != 3:
+                # <obj> missing
+                return None
+            obj_type, size = header[1], int(header[2])
+            content = self._process.stdout.read(size)
+            # Skip the trailing newline
+            self._process.stdout.read(1)
+        return obj_type, content
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+
+class CommitBuilder(object):
+    """Build commits on a branch in a temporary index
+
+    The working tree is not used. The branch is updated when the builder
+    is closed (the working tree is updated only if the branch is checked
+    out).
+    """
+
+    def __init__(self, repo, branch):
+        self.repo = repo
+        self.branch = branch
+        self.old_head = self.head = repo.rev_parse('refs/heads/%s' % branch)
+        fd, self.index_file = tempfile.mkstemp(prefix='addon-pr-index-')
+        os.close(fd)
+        # git refuses to read an empty index file
+        os.remove(self.index_file)
+        self.env = {'GIT_INDEX_FILE': self.index_file}
+        self.git('read-tree %s' % self.head)
+
+    def git(self, args, **kwargs):
+        """Run the git command using the temporary index"""
+        return self.repo.git(args, env=self.env, **kwargs)
+
+    def exists(self, path):
+        """Return True if path exists in the current head"""
+        return self.repo.has_path(self.head, path)
+
+    def replace_dir(self, path, source_dir):
+        """Replace path in the index by the content of source_dir
+
+        Only the entries of the files added, modified or removed are
+        updated.
+        """
+        changed, removed = self.repo.diff_dir(self.head, path, source_dir)
+        # Mode 0 removes the entry
+        index_info = ''.join(['%s %s\t%s\n' % (mode, sha, repo_path)
+                              for mode, sha, _, repo_path in changed] +
+                             ['0 %s\t%s\n' % ('0' * 40, repo_path)
+                              for repo_path in removed])
+        if index_info:
+            self.git('update-index --add --index-info', input=index_info)
+
+    def remove(self, paths):
+        """Remove paths from the index"""
+        self.git('rm --cached -r -q -- %s' % ' '.join(paths))
+
+    def commit(self, message):
+        """Commit the index on top of the current head"""
+        tree = self.git('write-tree')
+        self.head = self.git('commit-tree %s -p %s' % (tree, self.head),
+                             input=message)
+        return self.head
+
+    def close(self):
+        """Update the branch with the new commits"""
+        try:
+            if self.head == self.old_head:
+                return
+            if self.repo.current_branch() == self.branch:
+                # Update the index and working tree as well
+                self.repo.git('reset -q --keep %s' % self.head)
+            else:
+                self.repo.git('update-ref refs/heads/%s %s %s' % (
+                    self.branch, self.head, self.old_head))
+        finally:
+            if os.path.exists(self.index_file):
+                os.remove(self.index_file)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr imageinfo module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines functions to get the format and size of images
+by reading only their header. PIL is used as fallback.
+"""
+import struct
+import multiprocessing
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Number of images above which a pool of processes is used
+PARALLEL_MIN = 100
+
+
+def _get_jpeg_size(f):
+    """Return the (width, height) of the jpeg file f (after the SOI marker)"""
+    while True:
+        marker = f.read(2)
+        while marker[1:] == '\xff':
+            # Padding
+            marker = marker[1:] + f.read(1)
+        if len(marker) != 2 or marker[0] != '\xff':
+            return None
+        code = ord(marker[1])
+        if code == 0x01 or 0xd0 <= code <= 0xd7:
+            # Markers without length
+            continue
+        length = f.read(2)
+        if len(length) != 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+            # Start Of Frame: precision, height, width
+            data = f.read(5)
+            if len(data) != 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:])
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def sniff_image(f):
+    """Return (format, width, height) read from the header of the file f
+
+    format is 'png', 'jpeg' or 'gif'. Return None if the format is unknown
+    or the header is invalid.
+    """
+    head = f.read(24)
+    if head.startswith('\x89PNG\r\n\x1a\n') and head[12:16] == 'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return 'png', width, height
+    if head[:6] in ('GIF87a', 'GIF89a') and len(head) >= 10:
+        width, height = struct.unpack('<HH', head[6:10])
+        return 'gif', width, height
+    if head.startswith('\xff\xd8'):
+        f.seek(2)
+        size = _get_jpeg_size(f)
+        if size is not None:
+            return ('jpeg',) + size
+    return None
+
+
+def get_image_info(filename, source=None):
+    """Return (format, width, height) of the image filename
+
+    The image is read from source if given (see the sources module).
+    PIL is only used if the header can't be sniffed.
+    Raise IOError if the file can't be read or is not an image.
+    """
+    f = open(filename, 'rb') if source is None else source.open(filename)
+    try:
+        info = sniff_image(f)
+        if info is not None:
+            return info
+        f.seek(0)
+        from PIL import Image
+        img = Image.open(f)
+        return (img.format.lower(),) + img.size
+    finally:
+        f.close()
+
+
+def get_image_size(filename, source=None):
+    """Return (width, height) of the image filename
+
+    Raise IOError if the file can't be read or is not an image.
+    """
+    return get_image_info(filename, source)[1:]
+
+
+# Source of the images read by the pool processes
+_source = None
+
+
+def _init_worker(source):
+    global _source
+    _source = source
+
+
+def _get_image_info(filename, source=None):
+    try:
+        return get_image_info(filename, source)
+    except IOError:
+        return None
+
+
+def _get_worker_image_info(filename):
+    return _get_image_info(filename, _source)
+
+
+def get_images_info(filenames, source=None):
+    """Return the list of (format, width, height) of the images
+
+    None is returned for files that are not valid images.
+    Images are read by a pool of processes if there are many of them,
+    unless running in a pool process (like the --jobs workers): it can't
+    have children and the addons are already checked in parallel.
+    """
+    if (len(filenames) < PARALLEL_MIN or
+            multiprocessing.current_process().daemon):
+        return [_get_image_info(filename, source) for filename in filenames]
+    # The source is sent once to each process
+    pool = multiprocessing.Pool(initializer=_init_worker, initargs=(source,))
+    try:
+        return pool.map(_get_worker_image_info, filenames, chunksize=20)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr imapmail module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines functions to fetch the pull requests messages
+from an IMAP server with a minimum of round trips and bytes: only the
+subject and the first text/plain part of the messages are downloaded.
+The last message fetched and the pull requests not processed are stored
+to only fetch the new messages and the ones to process again.
+"""
+import os
+import re
+import json
+import email
+import email.message
+import imaplib
+import socket
+import tempfile
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# File storing the last message processed of each label
+DEFAULT_STATE_FILE = '~/.addon-pr.state'
+# Servers end IDLE after 30 minutes of inactivity
+IDLE_TIMEOUT = 29 * 60
+
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<open>\() |
+        (?P<close>\)) |
+        "(?P<quoted>(?:[^"\\]|\\.)*)" |
+        \{(?P<literal>\d+)\}$ |
+        (?P<atom>[^\s()"\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?|[^\s()"]+)
+    )""", re.VERBOSE)
+
+
+class Literal(str):
+    """IMAP literal string"""
+
+
+def _tokenize(data):
+    """Generator returning the tokens of the imaplib response data
+
+    Literals are returned as Literal instances, NIL as None
+    """
+    for item in data:
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        pos = 0
+        while True:
+            m = TOKEN_RE.match(text, pos)
+            if m is None or m.end() == pos:
+                break
+            pos = m.end()
+            if m.group('open'):
+                yield '('
+            elif m.group('close'):
+                yield ')'
+            elif m.group('quoted') is not None:
+                yield Literal(re.sub(r'\\(.)', r'\1', m.group('quoted')))
+            elif m.group('atom'):
+                atom = m.group('atom')
+                yield None if atom.upper() == 'NIL' else atom
+        if literal is not None:
+            yield Literal(literal)
+
+
+def parse_response(data):
+    """Return the list of items of the imaplib response data
+
+    Parenthesized lists are returned as python lists.
+    """
+    stack = [[]]
+    for token in _tokenize(data):
+        if token == '(' and not isinstance(token, Literal):
+            stack.append([])
+        elif token == ')' and not isinstance(token, Literal):
+            if len(stack) > 1:
+                items = stack.pop()
+                stack[-1].append(items)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def parse_fetch(data):
+    """Return {uid: {item name: value}} from the response of UID FETCH"""
+    messages = {}
+    for items in parse_response(data):
+        if not isinstance(items, list):
+            # Message sequence number
+            continue
+        values = dict((str(name).upper(), value)
+                      for name, value in zip(items[::2], items[1::2]))
+        if 'UID' in values:
+            messages.setdefault(int(values.pop('UID')), {}).update(values)
+    return messages
+
+
+def walk_structure(body, prefix='', number=None):
+    """Generator returning the (part number, content type, encoding)
+    of the BODYSTRUCTURE body in the order of email.message.Message.walk
+
+    number is the part number of body (None if body is the body of a
+    message). The part number of multipart bodies is None.
+    """
+    if isinstance(body[0], list):
+        yield None, 'multipart/%s' % _subtype(body), None
+        base = prefix if number is None else number + '.'
+        for i, part in enumerate(_parts(body), 1):
+            for item in walk_structure(part, number=base + str(i)):
+                yield item
+        return
+    if number is None:
+        number = prefix + '1'
+    content_type = ('%s/%s' % (body[0], body[1])).lower()
+    encoding = body[5] if len(body) > 5 else None
+    yield number, content_type, encoding
+    if content_type == 'message/rfc822' and len(body) > 8 and isinstance(body[8], list):
+        for item in walk_structure(body[8], prefix=number + '.'):
+            yield item
+
+
+def _parts(body):
+    """Return the parts of a multipart BODYSTRUCTURE"""
+    parts = []
+    for item in body:
+        if not isinstance(item, list):
+            break
+        parts.append(item)
+    return parts
+
+
+def _subtype(body):
+    return str(body[len(_parts(body))]).lower()
+
+
+def get_text_part(body):
+    """Return the (part number, encoding) of the first text/plain part
+
+    Return None if there is no text/plain part
+    """
+    for number, content_type, encoding in walk_structure(body):
+        if content_type == 'text/plain':
+            return number, encoding
+    return None
+
+
+def decode_payload(data, encoding):
+    """Return data decoded according to its content transfer encoding"""
+    part = email.message.Message()
+    if encoding is not None:
+        part['Content-Transfer-Encoding'] = encoding
+    part.set_payload(data)
+    return part.get_payload(decode=True)
+
+
+def fetch_messages(M, uids):
+    """Return the list of (uid, subject, text) of the messages uids
+
+    The structure and subject of all the messages are fetched in one
+    command. Then the first text/plain part of the messages is fetched
+    with one command per part number (usually only one).
+    The messages are not marked as read.
+    """
+    if not uids:
+        return []
+    uid_set = ','.join(str(uid) for uid in uids)
+    typ, data = M.uid('FETCH', uid_set,
+                      '(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT)])')
+    headers = parse_fetch(data)
+    subjects = {}
+    parts = {}
+    for uid in uids:
+        try:
+            values = headers[uid]
+            structure = values['BODYSTRUCTURE']
+        except KeyError:
+            logger.warning('Message %d not found. Skipping.', uid)
+            continue
+        header = [value for name, value in values.items()
+                  if name.startswith('BODY[HEADER')]
+        subjects[uid] = email.message_from_string(header and header[0] or '')['subject']
+        text_part = get_text_part(structure)
+        if text_part is None:
+            logger.warning('No text part in "%s". Skipping.', subjects[uid])
+            continue
+        parts.setdefault(text_part[0], []).append((uid, text_part[1]))
+    texts = {}
+    for number, messages in sorted(parts.items()):
+        typ, data = M.uid('FETCH', ','.join(str(uid) for uid, _ in messages),
+                          '(BODY.PEEK[%s])' % number)
+        bodies = parse_fetch(data)
+        for uid, encoding in messages:
+            body = bodies.get(uid, {}).get('BODY[%s]' % number)
+            if body is not None:
+                texts[uid] = decode_payload(body, encoding)
+    return [(uid, subjects[uid], texts[uid]) for uid in uids if uid in texts]
+
+
+def connect(mail):
+    """Return an IMAP4 connection logged in with the [mail] config
+
+    SSL is used unless the ssl option is false
+    """
+    if mail.get('ssl', 'true').lower() in ('0', 'false', 'no', 'off'):
+        M = imaplib.IMAP4(mail['server'], int(mail['port']))
+    else:
+        M = imaplib.IMAP4_SSL(mail['server'], int(mail['port']))
+    M.login(mail['username'], mail['password'])
+    return M
+
+
+def get_uidvalidity(M):
+    """Return the UIDVALIDITY of the selected mailbox (None if unknown)"""
+    typ, data = M.response('UIDVALIDITY')
+    if not data or data[0] is None:
+        return None
+    return int(data[-1])
+
+
+def search_uids(M, last_uid=0):
+    """Return the uids of the messages of the selected mailbox after last_uid"""
+    if last_uid:
+        typ, data = M.uid('SEARCH', None, 'UID', '%d:*' % (last_uid + 1))
+    else:
+        typ, data = M.uid('SEARCH', None, 'ALL')
+    # n:* always includes the last message
+    return [uid for uid in (int(uid) for uid in data[0].split())
+            if uid > last_uid]
+
+
+def _readline(M):
+    """Read a line from the server (imaplib returns '' on EOF)"""
+    line = M.readline()
+    if not line:
+        raise M.abort('socket error: EOF')
+    return line
+
+
+def _new_tag(M):
+    """Return the tag of a new command of the connection
+
+    imaplib has no public API to send the commands it doesn't support
+    (like IDLE): this relies on the private IMAP4._new_tag, checked with
+    the imaplib of Python 2.7.18.
+    """
+    return M._new_tag()
+
+
+def idle(M, timeout=IDLE_TIMEOUT):
+    """Wait for new messages in the selected mailbox using IMAP IDLE
+
+    Return True if the server notified new messages, False on timeout
+    """
+    # imaplib doesn't support IDLE
+    tag = _new_tag(M)
+    M.send('%s IDLE\r\n' % tag)
+    line = _readline(M)
+    if not line.startswith('+'):
+        raise M.error('IDLE failed: %s' % line.strip())
+    sock = M.ssl() if isinstance(M, imaplib.IMAP4_SSL) else M.socket()
+    new_messages = False
+    sock.settimeout(timeout)
+    try:
+        while not new_messages:
+            try:
+                line = _readline(M)
+            except socket.error as e:
+                # socket.timeout or ssl.SSLError
+                if 'timed out' not in str(e):
+                    raise
+                break
+            # * <n> EXISTS
+            new_messages = line.split()[2:3] == ['EXISTS']
+    finally:
+        sock.settimeout(None)
+    M.send('DONE\r\n')
+    while True:
+        line = _readline(M)
+        if line.startswith(tag + ' '):
+            break
+    if line.split()[1] != 'OK':
+        raise M.error('IDLE failed: %s' % line.strip())
+    return new_messages
+
+
+class SyncState(object):
+    """Last message fetched and pull requests not processed of each label
+
+    The uids are only valid for a given UIDVALIDITY of the label:
+    all the messages are fetched again if it changes.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, 'rb') as f:
+                self._labels = json.load(f)
+        except (IOError, ValueError):
+            self._labels = {}
+
+    def get_state(self, label, uidvalidity):
+        """Return the uid of the last message fetched (0 if none) and
+        {uid: indexes of the pull requests not processed} of the previous
+        messages
+        """
+        try:
+            state = self._labels[label]
+        except KeyError:
+            return 0, {}
+        if uidvalidity is None or uidvalidity != state[0]:
+            return 0, {}
+        last_uidvalidity, last_uid, pending = state
+        return last_uid, dict(pending)
+
+    def set_state(self, label, uidvalidity, uid, pending=None):
+        self._labels[label] = [uidvalidity, uid,
+                               sorted((pending or {}).items())]
+
+    def save(self):
+        dirname = os.path.dirname(self.filename) or '.'
+        fd, tmp_name = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(self._labels, f)
+        os.rename(tmp_name, self.filename)
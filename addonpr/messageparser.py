@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr messageparser module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines a parser of the addon blocks of the pull request
+messages:
+
+    addon: plugin.video.foo
+    version: 1.0.0
+    url: git://github.com/foo/plugin.video.foo.git
+    revision: v1.0.0 (optional, or tag)
+    branch: master (optional)
+    xbmc version: frodo, gotham
+
+It returns the same blocks as the regex previously used (ADDON_RE of
+tests/test_messageparser.py) in linear time. The regex backtracks
+heavily on long malformed messages (each blank line between two fields
+multiplies the ways to split them).
+Here each field is matched from the position of its keyword and the
+result is memoized, so each position of the message is examined once.
+"""
+import re
+import bisect
+import string
+
+
+# Characters classes of ADDON_RE
+# [\s\*]: prefix of the lines
+PREFIX_RE = re.compile(r'[\s*]*')
+PREFIX_CHARS = frozenset(' \t\n\r\f\v*')
+# [\s:=\-–]: separator between a keyword and its value
+# (the en dash is 3 bytes in utf-8, each one being part of the class)
+SEPARATOR_RE = re.compile(r'[\s:=\-\xe2\x80\x93]*')
+WHITESPACE_RE = re.compile(r'\s*')
+WORD_CHARS = string.ascii_letters + string.digits + '_'
+ID_CHARS = frozenset(WORD_CHARS + '.-')
+VERSION_CHARS = frozenset(string.digits + '.')
+URL_CHARS = frozenset(WORD_CHARS + '.@:/-')
+XBMC_VERSION_CHARS = frozenset(WORD_CHARS + ',/ ')
+
+
+def memoized(method):
+    """Decorator memoizing the result of a _BlockMatcher method by position"""
+    def wrapper(self, pos):
+        key = (method.__name__, pos)
+        try:
+            return self._memo[key]
+        except KeyError:
+            result = self._memo[key] = method(self, pos)
+            return result
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class _BlockMatcher(object):
+    """Match the fields of the addon blocks of a message
+
+    Each field method takes the position of its keyword and returns the
+    tuple of the values of this field and the following ones, followed
+    by the end position of the block (None if the block doesn't match).
+    When a field value can be split in several ways, they are tried in
+    the order of the regex.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._memo = {}
+        self._newlines = None
+
+    def _skip(self, run_re, pos):
+        return run_re.match(self.text, pos).end()
+
+    def _skip_chars(self, chars, pos):
+        text = self.text
+        end = pos
+        while end < len(text) and text[end] in chars:
+            end += 1
+        return end
+
+    def _find_newline(self, pos):
+        """Return the position of the first '\n' after pos (-1 if none)
+
+        The positions of the line ends are found once per message.
+        """
+        if self._newlines is None:
+            self._newlines = [m.start() for m in re.finditer('\n', self.text)]
+        index = bisect.bisect_left(self._newlines, pos)
+        if index == len(self._newlines):
+            return -1
+        return self._newlines[index]
+
+    @memoized
+    def _prefix_end(self, pos):
+        return self._skip(PREFIX_RE, pos)
+
+    def _is_line_start(self, pos):
+        return pos == 0 or self.text[pos - 1] == '\n'
+
+    def starts_line(self, pos, min_pos=0):
+        """Return True if the keyword at pos only follows a line prefix
+
+        The line shall start after min_pos (end of the previous block).
+        """
+        text = self.text
+        start = pos
+        while start > min_pos and text[start - 1] in PREFIX_CHARS:
+            start -= 1
+        return self._is_line_start(start) or '\n' in text[start:pos]
+
+    def _next_line(self, pos):
+        """Return the position of the keyword of a line starting after pos
+
+        Like \\s*^[\\s\\*]*: a new line shall start before any '*'.
+        Return None if there is no such line.
+        """
+        end = self._skip(PREFIX_RE, pos)
+        if self._is_line_start(pos):
+            return end
+        newline = self.text.find('\n', pos, end)
+        if newline == -1 or '*' in self.text[pos:newline]:
+            return None
+        return end
+
+    def _values(self, pos, chars, shorter=False):
+        """Generate the (start, end) of the values following the keyword
+
+        Like [\\s:=\\-–]*([chars]+): the separators are skipped, then the
+        separators that are also part of chars are given back one by one.
+        If shorter is True, the values are also shortened one char at a
+        time (the following field doesn't have to start a line).
+        Values with the same end (and so the same continuation) are
+        generated once.
+        """
+        text = self.text
+        separator_end = self._skip(SEPARATOR_RE, pos)
+        # End of the run of chars starting at the current start
+        run_end = self._skip_chars(chars, separator_end)
+        # Lowest end generated
+        low_end = run_end + 1
+        for start in xrange(separator_end, pos - 1, -1):
+            if start < separator_end and text[start] not in chars:
+                run_end = start
+                continue
+            end = min(run_end, low_end - 1)
+            while end > start and (shorter or end == run_end):
+                low_end = end
+                yield start, end
+                end -= 1
+
+    def _field(self, pos, keyword, chars, next_field):
+        """Match the field at pos, then next_field on a following line"""
+        for start, end in self._values(pos + len(keyword), chars):
+            next_pos = self._next_line(end)
+            if next_pos is not None:
+                result = next_field(next_pos)
+                if result is not None:
+                    return (self.text[start:end],) + result
+        return None
+
+    def addon(self, pos):
+        """Match the block whose addon keyword is at pos"""
+        return self._field(pos, 'addon', ID_CHARS, self.version)
+
+    @memoized
+    def version(self, pos):
+        if not self.text.startswith('version', pos):
+            return None
+        return self._field(pos, 'version', VERSION_CHARS, self.url)
+
+    @memoized
+    def url(self, pos):
+        if not self.text.startswith('url', pos):
+            return None
+        for start, end in self._values(pos + 3, URL_CHARS, shorter=True):
+            result = self.revision(end)
+            if result is not None:
+                return (self.text[start:end],) + result
+        return None
+
+    @memoized
+    def revision(self, pos):
+        """Match the optional revision (or tag) line after pos"""
+        keyword_pos = self._next_line(pos)
+        if keyword_pos is not None:
+            for keyword in ('revision', 'tag'):
+                if self.text.startswith(keyword, keyword_pos):
+                    for start, end in self._values(keyword_pos + len(keyword),
+                                                   ID_CHARS, shorter=True):
+                        result = self.branch(end)
+                        if result is not None:
+                            return (self.text[start:end],) + result
+        result = self.branch(pos)
+        if result is not None:
+            return ('',) + result
+        return None
+
+    @memoized
+    def branch(self, pos):
+        """Match the optional branch after pos (not necessarily on a new line)"""
+        keyword_pos = self._skip(PREFIX_RE, pos)
+        if self.text.startswith('branch', keyword_pos):
+            result = self._branch_value(keyword_pos + 6)
+            if result is not None:
+                return result
+        keyword_pos = self._next_line(pos)
+        if keyword_pos is not None:
+            return self.xbmc_version(keyword_pos)
+        return None
+
+    def _branch_value(self, pos):
+        """Match the branch value (any text) and the following xbmc version
+
+        Like [\\s:=\\-–]*.*?\\s*^[\\s\\*]*xbmc: for each way to split the
+        separators, the value can end at the start of the line (if it
+        starts one) or at the end of the line.
+        The ends of the line prefixes are updated while going backward,
+        so the separators are scanned once. The line end following the
+        separators and its prefix are looked up (each branch keyword
+        reached by a value of the previous field would scan them again).
+        """
+        text = self.text
+        separator_end = self._skip(SEPARATOR_RE, pos)
+        line_end = self._find_newline(separator_end)
+        if line_end != -1:
+            line_end_prefix = self._prefix_end(line_end)
+        # End of the line prefix starting at start
+        prefix_end = self._skip(PREFIX_RE, separator_end)
+        for start in xrange(separator_end, pos - 1, -1):
+            if start < separator_end and text[start] not in PREFIX_CHARS:
+                prefix_end = start
+            if start < len(text) and text[start] == '\n':
+                line_end = start
+                line_end_prefix = prefix_end
+            if self._is_line_start(start):
+                result = self.xbmc_version(prefix_end)
+                if result is not None:
+                    return result
+            if line_end != -1:
+                result = self.xbmc_version(line_end_prefix)
+                if result is not None:
+                    return result
+        return None
+
+    @memoized
+    def xbmc_version(self, pos):
+        text = self.text
+        if not text.startswith('xbmc', pos):
+            return None
+        version_pos = self._skip(WHITESPACE_RE, pos + 4)
+        if version_pos == pos + 4 or not text.startswith('version', version_pos):
+            return None
+        for start, end in self._values(version_pos + 7, XBMC_VERSION_CHARS):
+            # Last field: the first value is the one
+            return (text[start:end], end)
+        return None
+
+
+def find_addon_blocks(text):
+    """Return the list of (addon id, version, url, revision, xbmc version)
+
+    The revision is an empty string if not given.
+    """
+    matcher = _BlockMatcher(text)
+    blocks = []
+    block_end = 0
+    pos = text.find('addon')
+    while pos != -1:
+        if matcher.starts_line(pos, block_end):
+            result = matcher.addon(pos)
+            if result is not None:
+                blocks.append(result[:-1])
+                block_end = result[-1]
+                pos = text.find('addon', block_end)
+                continue
+        pos = text.find('addon', pos + 1)
+    return blocks
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr mirror module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines a cache of local mirrors of the upstream addons
+repositories, so that pulling a new version of an addon only fetches
+the new commits.
+"""
+import os
+import re
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import ConfigParser
+import logging
+from addonpr import command
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = '~/.cache/addon-pr-mirrors'
+# Default maximum size of the mirrors in MB
+DEFAULT_MAX_SIZE = 1024
+
+URL_RE = re.compile(r"""
+    ^(?:[a-z][a-z0-9+.\-]*://)?     # scheme
+    (?:[^@/]+@)?                    # user
+    ([^/:]+)                        # host
+    (?::\d+)?                       # port
+    [:/](.+)$                       # path
+    """, re.VERBOSE | re.IGNORECASE)
+
+
+def get_mirrors(config):
+    """Return the MirrorCache defined in the [mirror] section of config
+
+    Return None if the section is missing or max_size is 0
+    """
+    if not config.has_section('mirror'):
+        return None
+    try:
+        path = config.get('mirror', 'dir')
+    except ConfigParser.NoOptionError:
+        path = DEFAULT_DIR
+    try:
+        max_size = config.getint('mirror', 'max_size')
+    except ConfigParser.NoOptionError:
+        max_size = DEFAULT_MAX_SIZE
+    if max_size <= 0:
+        return None
+    return MirrorCache(os.path.expanduser(path), max_size * 1024 * 1024)
+
+
+def normalize_url(url):
+    """Return url without scheme, user, port, trailing slash and .git suffix
+
+    git://github.com/foo/bar.git, https://github.com/foo/bar/ and
+    git@github.com:foo/bar are the same repository.
+    """
+    url = url.strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-4]
+    m = URL_RE.match(url)
+    if m is None:
+        # Local path
+        return url
+    return '%s/%s' % (m.group(1).lower(), m.group(2).lstrip('/'))
+
+
+class MirrorCache(object):
+    """Local mirrors of the upstream repositories
+
+    Each mirror is a bare repository (or a repository without working
+    copy for mercurial) updated incrementally. The addon is exported from
+    the mirror. The least recently used mirrors are removed when the
+    total size exceeds max_size bytes.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # {mirror path: lock} (the same url can be pulled by several threads)
+        self._mirror_locks = {}
+
+    def _get_mirror(self, url, vcs):
+        """Return the (path, lock) of the mirror of url"""
+        key = hashlib.sha1(normalize_url(url)).hexdigest()
+        mirror = os.path.join(self.path, '%s.%s' % (key, vcs))
+        with self._lock:
+            lock = self._mirror_locks.setdefault(mirror, threading.Lock())
+        return mirror, lock
+
+    def _update(self, mirror, url, create_cmd, update_cmd):
+        """Create or update the mirror and return the size received"""
+        if os.path.isdir(mirror):
+            size = command.dir_size(mirror)
+            logger.debug('Updating mirror %s of %s', mirror, url)
+            command.run(update_cmd, cwd=mirror)
+            return command.dir_size(mirror) - size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        logger.debug('Creating mirror %s of %s', mirror, url)
+        # Clone in a temporary directory so that an interrupted clone
+        # doesn't leave an invalid mirror
+        tmp_mirror = tempfile.mkdtemp(dir=self.path, suffix='.tmp')
+        try:
+            command.run(create_cmd % tmp_mirror)
+            os.rename(tmp_mirror, mirror)
+        finally:
+            shutil.rmtree(tmp_mirror, ignore_errors=True)
+        return command.dir_size(mirror)
+
+    def git_pull(self, addon, url, revision):
+        """Export the given revision of url in addon using its mirror"""
+        start = time.time()
+        mirror, lock = self._get_mirror(url, 'git')
+        with lock:
+            size = self._update(mirror, url,
+                                'git clone -q --mirror "%s" %%s' % url,
+                                'git fetch -q --prune origin')
+            os.makedirs(addon)
+            # Checkout in a temporary index to leave the mirror untouched
+            fd, index_file = tempfile.mkstemp(prefix='addon-pr-index-')
+            os.close(fd)
+            os.remove(index_file)
+            env = {'GIT_INDEX_FILE': index_file}
+            git = 'git --git-dir="%s" --work-tree="%s" ' % (mirror, addon)
+            try:
+                command.run(git + 'read-tree "%s"' % (revision or 'HEAD'),
+                            env=env)
+                command.run(git + 'checkout-index -a', env=env)
+            finally:
+                command.silent_remove([index_file])
+            os.utime(mirror, None)
+        command.log_fetch(url, start, size)
+        command.silent_remove([os.path.join(addon, '.gitignore'),
+                               os.path.join(addon, '.gitattributes')])
+        self.evict()
+        return addon
+
+    def hg_pull(self, addon, url, revision):
+        """Export the given revision of url in addon using its mirror"""
+        start = time.time()
+        mirror, lock = self._get_mirror(url, 'hg')
+        with lock:
+            size = self._update(mirror, url,
+                                'hg clone --insecure -U "%s" %%s' % url,
+                                'hg pull --insecure -q')
+            command.run('hg archive --config ui.archivemeta=false -R "%s" '
+                        '-r "%s" %s' % (mirror, revision, addon))
+            os.utime(mirror, None)
+        command.log_fetch(url, start, size)
+        command.silent_remove([os.path.join(addon, '.hgignore')])
+        self.evict()
+        return addon
+
+    def _mirrors(self):
+        """Return the list of (mtime, size, path) of the mirrors"""
+        mirrors = []
+        for name in os.listdir(self.path):
+            if not name.endswith(('.git', '.hg')):
+                continue
+            mirror = os.path.join(self.path, name)
+            mirrors.append((os.path.getmtime(mirror),
+                            command.dir_size(mirror), mirror))
+        return mirrors
+
+    def evict(self):
+        """Remove the least recently used mirrors exceeding max_size
+
+        Mirrors being used by another thread are kept.
+        """
+        with self._lock:
+            mirrors = self._mirrors()
+            total_size = sum(size for _, size, _ in mirrors)
+            for mtime, size, mirror in sorted(mirrors):
+                if total_size <= self.max_size:
+                    break
+                lock = self._mirror_locks.setdefault(mirror, threading.Lock())
+                if not lock.acquire(False):
+                    continue
+                try:
+                    logger.debug('Removing mirror %s', mirror)
+                    shutil.rmtree(mirror, ignore_errors=True)
+                finally:
+                    lock.release()
+                total_size -= size
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr profiler module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines an optional profiler of the checks and pull requests
+(--profile option). It records the wall time, CPU time, addon files
+opened, bytes read and subprocesses run by command.run of each measured
+block. All the functions do nothing until enable() is called.
+"""
+import sys
+import json
+import time
+import ctypes
+import ctypes.util
+import threading
+import contextlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Counters of the records (besides the wall and CPU times)
+COUNTERS = ('files', 'bytes', 'subprocesses', 'subprocess_time')
+# (kind, title) of the records summarized
+SUMMARY = (('check', 'Slowest checks'),
+           ('file', 'Slowest files'),
+           ('addon', 'Slowest addons'),
+           ('pull_request', 'Slowest pull request stages'),
+           ('mail', 'Mail'),
+           ('subprocess', 'Slowest subprocesses'))
+
+_profiler = None
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_thread_time():
+    """Return a function returning the CPU time of the current thread
+
+    Fall back to the CPU time of the process if the platform doesn't
+    support clock_gettime(CLOCK_THREAD_CPUTIME_ID).
+    """
+    clock_id = {'linux': 3, 'darwin': 16}.get(sys.platform.rstrip('0123456789'))
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        clock_id = None
+    if clock_id is None:
+        return time.clock
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def thread_time():
+        timespec = _Timespec()
+        if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            return time.clock()
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return thread_time
+
+
+thread_time = _get_thread_time()
+
+
+def enable():
+    """Enable the profiler and return it"""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def get_profiler():
+    """Return the Profiler (None if not enabled)"""
+    return _profiler
+
+
+def measure(kind, name, **info):
+    """Return a context manager measuring the enclosed block"""
+    if _profiler is None:
+        return _null_context()
+    return _profiler.measure(kind, name, **info)
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+def count_read(size, opened=True):
+    """Count size bytes read (from a new file if opened is True)"""
+    if _profiler is not None:
+        _profiler.count(files=1 if opened else 0, bytes=size)
+
+
+def count_subprocess(cmd, duration):
+    """Count the subprocess cmd which took duration seconds"""
+    if _profiler is not None:
+        _profiler.count_subprocess(cmd, duration)
+
+
+def track_file(f):
+    """Return f counting its reads if the profiler is enabled"""
+    if _profiler is None:
+        return f
+    count_read(0)
+    return _TrackedFile(f)
+
+
+class _TrackedFile(object):
+    """File object counting the bytes read"""
+
+    def __init__(self, f):
+        self._file = f
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+    def __iter__(self):
+        for line in self._file:
+            count_read(len(line), opened=False)
+            yield line
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        count_read(len(data), opened=False)
+        return data
+
+    def readline(self, *args):
+        data = self._file.readline(*args)
+        count_read(len(data), opened=False)
+        return data
+
+
+class Profiler(object):
+    """Records of the measured blocks
+
+    Records are identified by their kind (check, file, pull_request...),
+    name and info: measuring the same block several times sums its
+    counters. The counters of a block include the ones of the blocks it
+    encloses (in the same thread).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        # Order of the records in the report
+        self._keys = []
+        self._local = threading.local()
+
+    def _frames(self):
+        try:
+            return self._local.frames
+        except AttributeError:
+            frames = self._local.frames = []
+            return frames
+
+    def _add(self, kind, name, info, values, calls=1):
+        key = (kind, name, tuple(sorted(info.items())))
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = dict(info, kind=kind, name=name, calls=0, wall=0,
+                              cpu=0, **dict.fromkeys(COUNTERS, 0))
+                self._records[key] = record
+                self._keys.append(key)
+            record['calls'] += calls
+            for counter, value in values.items():
+                record[counter] += value
+
+    @contextlib.contextmanager
+    def measure(self, kind, name, **info):
+        frame = dict.fromkeys(COUNTERS, 0)
+        frames = self._frames()
+        frames.append(frame)
+        start, start_cpu = time.time(), thread_time()
+        try:
+            yield
+        finally:
+            frame['wall'] = time.time() - start
+            frame['cpu'] = thread_time() - start_cpu
+            frames.pop()
+            self._add(kind, name, info, frame)
+
+    def count(self, **values):
+        """Add values to the counters of the blocks being measured"""
+        for frame in self._frames():
+            for counter, value in values.items():
+                frame[counter] += value
+
+    def count_subprocess(self, cmd, duration):
+        self.count(subprocesses=1, subprocess_time=duration)
+        self._add('subprocess', cmd, {}, {'wall': duration})
+
+    def get_records(self):
+        """Return the list of records (dictionaries)"""
+        with self._lock:
+            return [dict(self._records[key]) for key in self._keys]
+
+    def pop_records(self):
+        """Return the list of records and remove them"""
+        with self._lock:
+            records = [self._records.pop(key) for key in self._keys]
+            self._keys = []
+        return records
+
+    def add_records(self, records):
+        """Add records (like the ones of another process)"""
+        for record in records:
+            record = dict(record)
+            kind, name = record.pop('kind'), record.pop('name')
+            calls = record.pop('calls')
+            values = dict((counter, record.pop(counter))
+                          for counter in ('wall', 'cpu') + COUNTERS)
+            self._add(kind, name, record, values, calls)
+
+    def get_slowest(self, kind, count=10):
+        """Return the count slowest records of kind"""
+        records = [record for record in self.get_records() if record['kind'] == kind]
+        return sorted(records, key=lambda record: record['wall'], reverse=True)[:count]
+
+    def get_report(self, count=10):
+        """Return the report: all the records and the slowest ones by kind"""
+        return {'records': self.get_records(),
+                'slowest': dict((kind, self.get_slowest(kind, count))
+                                for kind, title in SUMMARY)}
+
+    def save(self, filename, count=10):
+        """Write the report to filename (JSON)"""
+        with open(filename, 'wb') as f:
+            json.dump(self.get_report(count), f, indent=2, sort_keys=True)
+
+    def log_summary(self, count=10):
+        """Log the slowest records of each kind of SUMMARY"""
+        for kind, title in SUMMARY:
+            records = self.get_slowest(kind, count)
+            if not records:
+                continue
+            logger.info('%s (wall s, cpu s, files, KB read, subprocesses):', title)
+            for record in records:
+                name = record['name']
+                if 'addon' in record:
+                    name = '%s (%s)' % (name, record['addon'])
+                elif 'stage' in record:
+                    name = '%s %s' % (name, record['stage'])
+                logger.info('  %8.3f %8.3f %6d %8d %4d  %s', record['wall'],
+                            record['cpu'], record['files'],
+                            record['bytes'] // 1024, record['subprocesses'],
+                            name)
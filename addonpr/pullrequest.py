@@ -23,29 +23,25 @@ This module defines the main functions to parse and
 process pull requests.
 """
 import os
-import imaplib
-import email
 import re
 import ConfigParser
 import tempfile
 import shutil
+import time
+import socket
+import imaplib
+import threading
+import Queue
 import logging
-from addonpr import command, addonparser
+import multiprocessing
+from addonpr import command, addonparser, cache, gitrepo, mirror, imapmail, \
+    messageparser, profiler, utils
 from config import BRANCHES
 
 PULL_RE = re.compile(r"""
     \[(\w+)[\s\-]*pull\]
     """, re.VERBOSE | re.IGNORECASE)
 
-ADDON_RE = re.compile(r"""
-    ^[\s\*]*addon[\s:=\-–]*([\w\.\-]+)\s*
-    ^[\s\*]*version[\s:=\-–]*([\d\.]+)\s*
-    ^[\s\*]*url[\s:=\-–]*([\w\.@:\/\-]+)\s*
-    (?:^[\s\*]*(?:revision|tag)[\s:=\-–]*([\w\.\-]+)\s*)?
-    (?:[\s\*]*branch[\s:=\-–]*.*?\s*)?
-    ^[\s\*]*xbmc\s+version[\s:=\-–]*([\w\,\/\ ]+)
-    """, re.VERBOSE | re.MULTILINE)
-
 
 logger = logging.getLogger(__name__)
 
@@ -68,7 +64,7 @@ def parse_message(subject, request):
     if pull_type is None:
         logger.warning('Unknown pull type for "%s". Skipping.', subject)
         return []
-    for match in ADDON_RE.findall(request):
+    for match in messageparser.find_addon_blocks(request):
         addon_id, addon_version, url, revision, xbmc_version = match
         xbmc_branches = [branch.lower() for branch in re.split('\W+', xbmc_version)
                             if branch and branch != 'and']
@@ -89,83 +85,380 @@ def parse_message(subject, request):
     return pull_requests
 
 
-def do_pr(addon_id, addon_version, url, revision, xbmc_branch, pull_type,
-          git_parent_dir, tmp_dir, force=False):
-    logger.info('Processing %s (%s) pull request for %s...', addon_id,
-        addon_version, xbmc_branch)
-    # Pull the addon in a temporary directory
-    os.chdir(tmp_dir)
+def fetch_pr(addon_id, url, revision, pull_type, work_dir, mirrors=None):
+    """Pull the addon in work_dir and return its path
+
+    The path is the one of the archive for zip pull requests.
+    The mirrors are used if given (MirrorCache) and the pull type supports it.
+    Return None if the pull type is unknown
+    """
+    addon_path = os.path.join(work_dir, addon_id)
     try:
-        getattr(command, pull_type + '_pull')(addon_id, url, revision)
+        if mirrors is not None and hasattr(mirrors, pull_type + '_pull'):
+            pull = getattr(mirrors, pull_type + '_pull')
+        else:
+            pull = getattr(command, pull_type + '_pull')
     except AttributeError:
         logger.error('Unknown pull request type: %s. Aborting.', pull_type)
-        return
-    # Check the addon
+        return None
+    return pull(addon_path, url, revision)
+
+
+def check_pr(addon_path, addon_id, addon_version, xbmc_branch,
+             git_parent_dir, force=False, result_cache=None):
+    """Check the pulled addon and return the AddonCheck instance
+
+    Return None if the pull request shall not be committed
+    """
     try:
-        addon_check = addonparser.AddonCheck(addon_id,
+        addon_check = addonparser.AddonCheck(addon_path,
                 xbmc_branch,
                 addon_id,
                 addon_version,
-                git_parent_dir)
+                git_parent_dir,
+                result_cache,
+                incremental=True)
     except Exception as e:
         logger.error(e)
         logger.error("Aborting.")
-        return
+        return None
     else:
         (warnings, errors) = addon_check.run()
     if errors > 0:
         if force:
             logger.warning("Error(s) detected. Processing anyway (force=True).")
         else:
-            shutil.rmtree(addon_id, ignore_errors=True)
+            if os.path.isdir(addon_path):
+                shutil.rmtree(addon_path, ignore_errors=True)
+            else:
+                command.silent_remove([addon_path])
             logger.error("Error(s) detected. Aborting.")
-            return
+            return None
+    return addon_check
+
+
+def _check_pr_worker(addon_path, addon_id, addon_version, xbmc_branch,
+                     git_parent_dir, force, result_cache):
+    """Check the pull request in a worker process
+
+    Return True if the pull request shall be committed (the AddonCheck
+    instance stays in the worker).
+    """
+    try:
+        return check_pr(addon_path, addon_id, addon_version, xbmc_branch,
+                        git_parent_dir, force, result_cache) is not None
+    except (Exception, SystemExit) as e:
+        # command.run exits on error: the worker shall keep running
+        logger.error('check_pr failed: %r. Aborting.', e)
+        return False
+
+
+def get_commit_message(addon, addon_id, addon_version, exists):
+    """Return the commit message of the pull request
+
+    exists shall be True if the addon was already in the repository
+    """
+    if exists:
+        if addon.is_broken():
+            return '[%s] marked as broken' % addon_id
+        return '[%s] updated to version %s' % (addon_id, addon_version)
+    return '[%s] initial version (%s) thanks to %s' % (addon_id,
+                addon_version, addon.provider)
+
+
+def extract_pr(addon_check):
+    """Extract the checked addon if it was checked in its archive
+
+    addon_check.addon_path is updated with the extracted directory
+    """
+    source = addon_check.source
+    if not source.is_archive:
+        return
+    dest_dir = tempfile.mkdtemp(dir=os.path.dirname(source.zip_path))
+    addon_check.addon_path = source.extract(addon_check.addon_path, dest_dir)
+    command.silent_remove([source.zip_path])
+
+
+def commit_pr(addon_check, addon_id, addon_version, xbmc_branch,
+              git_parent_dir):
+    """Commit the checked addon to the local git repository
+
+    Return True if the addon was committed
+    """
     addon = addon_check.addon
-    addon_path = addon_check.addon_path
     if git_parent_dir is None:
         logger.error('Git parent dir not set. Aborting.')
         return
     git_dir = os.path.join(git_parent_dir, addon.addon_type + 's')
-    try:
-        os.chdir(git_dir)
-    except OSError as e:
-        logger.error('OSError: %s', e.strerror)
+    if not os.path.isdir(git_dir):
+        logger.error('OSError: No such directory: %s', git_dir)
         return
-    command.run('git checkout -qf %s' % xbmc_branch)
-    if os.path.isdir(addon_id):
-        command.run('git rm -rfq %s' % addon_id)
-        # Directory might still exist due to files in .gitignore
-        shutil.rmtree(addon_id, ignore_errors=True)
-        if addon.is_broken():
-            msg = '[%s] marked as broken' % addon_id
+    extract_pr(addon_check)
+    repo = gitrepo.GitRepo(git_dir)
+    with command.git_lock:
+        command.run('git checkout -qf %s' % xbmc_branch, cwd=git_dir)
+        exists = os.path.isdir(os.path.join(git_dir, addon_id))
+        msg = get_commit_message(addon, addon_id, addon_version, exists)
+        if exists:
+            # Only the files that changed are replaced and staged
+            repo.update_dir(addon_id, addon_check.addon_path)
+            shutil.rmtree(addon_check.addon_path, ignore_errors=True)
         else:
-            msg = '[%s] updated to version %s' % (addon_id, addon_version)
-    else:
-        msg = '[%s] initial version (%s) thanks to %s' % (addon_id,
-                    addon_version, addon.provider)
-    shutil.move(os.path.join(tmp_dir, addon_path), addon_id)
-    command.run('git add %s' % addon_id)
-    command.run('git commit -m "%s"' % msg)
+            shutil.move(addon_check.addon_path, os.path.join(git_dir, addon_id))
+            command.run('git add %s' % addon_id, cwd=git_dir)
+        command.run('git commit -m "%s"' % msg, cwd=git_dir)
+    return True
+
+
+def pr_name(pr):
+    """Return the name of the pull request used in the profile"""
+    return '%s %s (%s)' % (pr['addon_id'], pr['addon_version'],
+                           pr['xbmc_branch'])
+
+
+def commit_batch(checked_prs, git_parent_dir):
+    """Commit the checked pull requests to the local git repositories
+
+    checked_prs is a list of (pull request, AddonCheck instance).
+    Pull requests are grouped by repository and branch. Commits are built
+    with plumbing commands without checking out the branches. Each pull
+    request gets its own commit. Return the indexes in checked_prs of the
+    pull requests committed.
+    """
+    if git_parent_dir is None:
+        logger.error('Git parent dir not set. Aborting.')
+        return []
+    groups = {}
+    for index, (pr, addon_check) in enumerate(checked_prs):
+        git_dir = os.path.join(git_parent_dir,
+                               addon_check.addon.addon_type + 's')
+        groups.setdefault((git_dir, pr['xbmc_branch']), []).append(
+            (index, pr, addon_check))
+    committed = []
+    with command.git_lock:
+        for (git_dir, xbmc_branch), prs in sorted(groups.items()):
+            if not os.path.isdir(git_dir):
+                logger.error('OSError: No such directory: %s', git_dir)
+                continue
+            logger.info('Committing %d pull request(s) to %s (%s)', len(prs),
+                        git_dir, xbmc_branch)
+            builder = gitrepo.CommitBuilder(gitrepo.GitRepo(git_dir),
+                                            xbmc_branch)
+            group_committed = []
+            try:
+                for index, pr, addon_check in prs:
+                    addon_id = pr['addon_id']
+                    msg = get_commit_message(addon_check.addon, addon_id,
+                                             pr['addon_version'],
+                                             builder.exists(addon_id))
+                    with profiler.measure('pull_request', pr_name(pr),
+                                          stage='commit'):
+                        extract_pr(addon_check)
+                        builder.replace_dir(addon_id, addon_check.addon_path)
+                        builder.commit(msg)
+                    group_committed.append(index)
+                    shutil.rmtree(addon_check.addon_path, ignore_errors=True)
+            except (Exception, SystemExit) as e:
+                # command.run exits on error: the previous commits are kept
+                logger.error('Commit of %s failed: %r. Aborting.',
+                             pr_name(pr), e)
+            finally:
+                builder.close()
+            committed.extend(group_committed)
+    return sorted(committed)
+
+
+class Pipeline(object):
+    """Fetch, check and commit pull requests concurrently
+
+    Pull requests are fetched by several threads (network bound) and
+    checked by a pool of processes (CPU bound). The stages are connected
+    by bounded queues. Commits are done by a single thread in the order
+    the pull requests were given, so that the history of the repositories
+    is deterministic. The logs of the checks are replayed by this thread
+    as well (the logs of the pull requests are not mixed).
+    """
+
+    def __init__(self, git_parent_dir, tmp_dir, force=False, result_cache=None,
+                 batch=False, fetchers=4, checkers=2, queue_size=4,
+                 mirrors=None):
+        self.git_parent_dir = git_parent_dir
+        self.tmp_dir = tmp_dir
+        self.force = force
+        self.result_cache = result_cache
+        self.mirrors = mirrors
+        self.batch = batch
+        self.fetchers = fetchers
+        self.checkers = checkers
+        self.queue_size = queue_size
+
+    @staticmethod
+    def _call(func, *args):
+        """Call func and return its result (None on error)"""
+        try:
+            return func(*args)
+        except (Exception, SystemExit) as e:
+            # command.run exits on error: only abort this pull request
+            logger.error('%s failed: %r. Aborting.', func.__name__, e)
+            return None
+
+    def _fetch(self, fetch_queue, check_queue):
+        while True:
+            item = fetch_queue.get()
+            if item is None:
+                break
+            index, pr = item
+            logger.info('Processing %s (%s) pull request for %s...',
+                        pr['addon_id'], pr['addon_version'], pr['xbmc_branch'])
+            # Each pull request gets its own directory as the same addon
+            # can be pulled for several branches
+            work_dir = os.path.join(self.tmp_dir, str(index))
+            os.mkdir(work_dir)
+            with profiler.measure('pull_request', pr_name(pr), stage='fetch'):
+                addon_path = self._call(fetch_pr, pr['addon_id'], pr['url'],
+                                        pr['revision'], pr['pull_type'],
+                                        work_dir, self.mirrors)
+            check_queue.put((index, pr, addon_path))
+
+    def _check(self, pool, check_queue, commit_queue):
+        """Check the pull requests in the pool (one at a time per thread)"""
+        main_profiler = profiler.get_profiler()
+        while True:
+            item = check_queue.get()
+            if item is None:
+                break
+            index, pr, addon_path = item
+            addon_check = None
+            records = []
+            if addon_path is not None:
+                with profiler.measure('pull_request', pr_name(pr), stage='check'):
+                    result = self._call(pool.apply, utils.call_recorded, (
+                        _check_pr_worker, addon_path, pr['addon_id'],
+                        pr['addon_version'], pr['xbmc_branch'],
+                        self.git_parent_dir, self.force, self.result_cache))
+                if result is not None:
+                    accepted, records, profile = result
+                    if main_profiler is not None:
+                        main_profiler.add_records(profile)
+                    if accepted:
+                        # Only the addon and its files are needed to commit
+                        addon_check = self._call(
+                            addonparser.AddonCheck, addon_path,
+                            pr['xbmc_branch'], pr['addon_id'],
+                            pr['addon_version'], self.git_parent_dir)
+            commit_queue.put((index, pr, addon_check, records))
+
+    def _commit(self, commit_queue, committed):
+        pending = {}
+        checked_prs = []
+        checked_indexes = []
+        next_index = 0
+        while True:
+            item = commit_queue.get()
+            if item is None:
+                break
+            index, pr, addon_check, records = item
+            pending[index] = (pr, addon_check, records)
+            # Commit in the original order
+            while next_index in pending:
+                pr, addon_check, records = pending.pop(next_index)
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if addon_check is None:
+                    pass
+                elif self.batch:
+                    checked_prs.append((pr, addon_check))
+                    checked_indexes.append(next_index)
+                else:
+                    with profiler.measure('pull_request', pr_name(pr),
+                                          stage='commit'):
+                        if self._call(commit_pr, addon_check, pr['addon_id'],
+                                      pr['addon_version'], pr['xbmc_branch'],
+                                      self.git_parent_dir):
+                            committed.append(next_index)
+                next_index += 1
+        if checked_prs:
+            committed.extend(checked_indexes[i] for i in self._call(
+                commit_batch, checked_prs, self.git_parent_dir) or [])
+
+    def _start(self, number, target, *args):
+        threads = [threading.Thread(target=target, args=args)
+                   for i in range(number)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def run(self, pull_requests):
+        """Process all the pull requests
+
+        Return the indexes of the pull requests committed
+        """
+        committed = []
+        fetch_queue = Queue.Queue()
+        check_queue = Queue.Queue(self.queue_size)
+        commit_queue = Queue.Queue(self.queue_size)
+        # Started before the threads (forking a threaded process is unsafe)
+        pool = multiprocessing.Pool(self.checkers, utils.init_worker,
+                                    (logging.getLogger().getEffectiveLevel(),
+                                     profiler.get_profiler() is not None))
+        try:
+            fetchers = self._start(self.fetchers, self._fetch, fetch_queue,
+                                   check_queue)
+            checkers = self._start(self.checkers, self._check, pool,
+                                   check_queue, commit_queue)
+            committer = self._start(1, self._commit, commit_queue, committed)
+            for index, pr in enumerate(pull_requests):
+                fetch_queue.put((index, pr))
+            # Stop each stage once the previous one is done
+            for threads, queue in ((fetchers, fetch_queue),
+                                   (checkers, check_queue),
+                                   (committer, commit_queue)):
+                for thread in threads:
+                    queue.put(None)
+                for thread in threads:
+                    thread.join()
+        finally:
+            pool.terminate()
+            pool.join()
+        return sorted(committed)
 
 
 class Parser(object):
 
-    def __init__(self, conf, mail=None, filename=None, interactive=False, force=False, **kwargs):
+    def __init__(self, conf, mail=None, filename=None, interactive=False, force=False,
+                 clear_cache=False, batch=False, resync=False, **kwargs):
         self.mail_url = mail
         self.filename = filename
         self.interactive = interactive
         self.force = force
+        self.batch = batch
+        self.resync = resync
         self.kwargs = kwargs
         config = ConfigParser.ConfigParser()
         config.read(os.path.expanduser(conf))
+        self.result_cache = cache.get_cache(config, clear_cache)
+        self.mirrors = mirror.get_mirrors(config)
         try:
             self.mail = dict(config.items('mail'))
         except ConfigParser.NoSectionError:
             self.mail = None
+        self.sync_state = None
+        if self.mail is not None:
+            self.sync_state = imapmail.SyncState(os.path.expanduser(
+                self.mail.get('state_file', imapmail.DEFAULT_STATE_FILE)))
+        # (label, uidvalidity, last uid, ids of the pull requests) of the
+        # messages to mark as processed
+        self._messages = None
         try:
             self.git_parent_dir = config.get('git', 'parent_dir')
         except ConfigParser.NoSectionError:
             self.git_parent_dir = None
+        try:
+            self.pipeline = dict((option, config.getint('pipeline', option))
+                                 for option in config.options('pipeline'))
+        except ConfigParser.NoSectionError:
+            self.pipeline = {}
 
     def get_pr_from_kwargs(self):
         return [self.kwargs]
@@ -177,64 +470,139 @@ class Parser(object):
                     msg.splitlines()[0], msg)
         return pull_requests
 
+    def _get_new_pr(self, M, uidvalidity):
+        """Return the pull requests of the label received since the last run
+
+        The pull requests of the previous runs that were not committed
+        are returned again. They are marked as processed once committed.
+        """
+        label = self.mail['label']
+        last_uid, pending = 0, {}
+        if not self.resync:
+            last_uid, pending = self.sync_state.get_state(label, uidvalidity)
+        uids = imapmail.search_uids(M, last_uid)
+        logger.info('%d new message(s) in %s', len(uids), label)
+        if pending:
+            logger.info('%d pull request(s) not processed previously',
+                        sum(len(indexes) for indexes in pending.values()))
+        pull_requests = []
+        # (uid of the message, index in the message) of each pull request
+        pr_ids = []
+        for uid, subject, payload in imapmail.fetch_messages(
+                M, sorted(pending) + uids):
+            for index, pr in enumerate(parse_message(subject, payload)):
+                if uid not in pending or index in pending[uid]:
+                    pull_requests.append(pr)
+                    pr_ids.append((uid, index))
+        self._messages = (label, uidvalidity, max([last_uid] + uids), pr_ids)
+        return pull_requests
+
+    def _mark_processed(self, committed):
+        """Store the messages processed in the sync state
+
+        committed are the indexes of the pull requests committed: the
+        other ones are returned again by the next _get_new_pr.
+        """
+        if self._messages is not None:
+            label, uidvalidity, last_uid, pr_ids = self._messages
+            pending = {}
+            for i, (uid, index) in enumerate(pr_ids):
+                if i not in committed:
+                    pending.setdefault(uid, []).append(index)
+            self.sync_state.set_state(label, uidvalidity, last_uid, pending)
+            self.sync_state.save()
+            self._messages = None
+
     def get_pr_from_mail(self):
         if self.mail is None:
             logger.error('Missing mail section in config. Aborting.')
             return []
         pull_requests = []
-        M = imaplib.IMAP4_SSL(self.mail['server'],
-                              self.mail['port'])
-        M.login(self.mail['username'],
-                self.mail['password'])
+        M = imapmail.connect(self.mail)
         if self.mail_url:
             # Get the thread id from url
             hexid = self.mail_url.split('/')[-1]
             thrid = int(hexid, 16)
             # Search by thread id
             status, count = M.select('inbox', readonly=True)
-            typ, data = M.search(None, '(X-GM-THRID "%d")' % thrid)
+            typ, data = M.uid('SEARCH', None, '(X-GM-THRID "%d")' % thrid)
             # There might be several messages in the thread
             # Take only the last one
-            msg_ids = data[0].split()[-1:]
+            uids = [int(uid) for uid in data[0].split()[-1:]]
+            for uid, subject, payload in imapmail.fetch_messages(M, uids):
+                pull_requests.extend(parse_message(subject, payload))
         else:
             # Search by label
             status, count = M.select(self.mail['label'], readonly=True)
             if status.lower() == 'no':
                 logger.error('Label does not exist. Aborting.')
                 return []
-            typ, data = M.search(None, 'ALL')
-            msg_ids = data[0].split()
-        for num in msg_ids:
-            typ, msg_data = M.fetch(num, '(RFC822)')
-            msg = email.message_from_string(msg_data[0][1])
-            for part in msg.walk():
-                if part.get_content_type() == 'text/plain':
-                    payload = part.get_payload(decode=True)
-                    # Only first part should contain interesting information
-                    break
-            pull_requests.extend(parse_message(msg['subject'], payload))
+            pull_requests = self._get_new_pr(M, imapmail.get_uidvalidity(M))
         M.close()
         M.logout()
         return pull_requests
 
+    def run_daemon(self, retry_delay=60):
+        """Process the pull requests of the label as soon as they are received
+
+        The connection is kept open and IMAP IDLE is used to wait for
+        new messages. Reconnect after retry_delay seconds if the
+        connection is lost.
+        """
+        if self.mail is None:
+            logger.error('Missing mail section in config. Aborting.')
+            return
+        while True:
+            try:
+                M = imapmail.connect(self.mail)
+                status, count = M.select(self.mail['label'], readonly=True)
+                if status.lower() == 'no':
+                    logger.error('Label does not exist. Aborting.')
+                    return
+                uidvalidity = imapmail.get_uidvalidity(M)
+                new_messages = True
+                while True:
+                    if new_messages:
+                        self.process(self._get_new_pr(M, uidvalidity))
+                        self.resync = False
+                    logger.debug('Waiting for new messages')
+                    new_messages = imapmail.idle(M)
+            except (imaplib.IMAP4.abort, socket.error) as e:
+                logger.warning('Connection lost (%s). Reconnecting in %ds.',
+                               e, retry_delay)
+                time.sleep(retry_delay)
+
     def get_pr(self):
         if self.filename:
             pull_requests = self.get_pr_from_file()
         elif self.kwargs:
             pull_requests = self.get_pr_from_kwargs()
         else:
-            pull_requests = self.get_pr_from_mail()
+            with profiler.measure('mail', self.mail_url or 'label'):
+                pull_requests = self.get_pr_from_mail()
         return pull_requests
 
-    def process(self):
-        # Create a temporary directory
-        tmp_dir = tempfile.mkdtemp()
-        for pr in self.get_pr():
+    def process(self, pull_requests=None):
+        """Process the given pull requests (by default the ones of get_pr)"""
+        if pull_requests is None:
+            pull_requests = self.get_pr()
+        accepted = []
+        for index, pr in enumerate(pull_requests):
             if self.interactive:
                 answer = raw_input('Process %s (%s) pull request for %s (y/N)? ' % (pr['addon_id'],
                              pr['addon_version'], pr['xbmc_branch']))
             else:
                 answer = 'y'
             if answer.lower() in ('y', 'yes'):
-                do_pr(git_parent_dir=self.git_parent_dir, force=self.force, tmp_dir=tmp_dir, **pr)
-        shutil.rmtree(tmp_dir)
+                accepted.append(index)
+        # Create a temporary directory
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pipeline = Pipeline(self.git_parent_dir, tmp_dir, self.force,
+                                self.result_cache, self.batch,
+                                mirrors=self.mirrors, **self.pipeline)
+            committed = pipeline.run([pull_requests[index]
+                                      for index in accepted])
+        finally:
+            shutil.rmtree(tmp_dir)
+        self._mark_processed(set(accepted[index] for index in committed))
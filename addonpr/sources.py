@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr sources module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines the sources of the addon files read by the checks:
+a directory, a zip archive (without extracting it) or a revision of a git
+repository (without checking it out).
+"""
+import io
+import os
+import zipfile
+import threading
+import logging
+from addonpr import profiler, gitrepo
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_source(path):
+    """Return the source of the files under path
+
+    path can be a directory or a zip archive
+    """
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        return ZipSource(path)
+    return DirSource()
+
+
+class DirSource(object):
+    """Files of the local filesystem"""
+
+    is_archive = False
+
+    def join(self, *paths):
+        return os.path.join(*paths)
+
+    def open(self, filename):
+        return profiler.track_file(open(filename, 'rb'))
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        profiler.count_read(len(data))
+        return data
+
+    def get_file_keys(self, filenames):
+        """Return the identifiers of the content of the files
+
+        The git blob sha1 of the files (computed by git in one process).
+        """
+        return gitrepo.hash_blobs(filenames)
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def walk_files(self, path):
+        """Return the list of all the files under path"""
+        return [os.path.join(root, name)
+                for root, dirs, files in os.walk(path)
+                for name in files]
+
+
+class _MemberSource(object):
+    """Base class of the sources made of members stored under a root path
+
+    The path of a member is the root followed by the member name.
+    Subclasses define root, the list of member names (_names) and
+    implement read.
+    """
+
+    def _set_names(self, names):
+        self._names = names
+        self._files = set(names)
+        # Directories are not always stored
+        self._dirs = set()
+        for name in names:
+            parts = name.split('/')[:-1]
+            for i in range(1, len(parts) + 1):
+                self._dirs.add('/'.join(parts[:i]))
+
+    def _member(self, path):
+        """Return the member name of path ('' for the root)"""
+        if path == self.root:
+            return ''
+        if not path.startswith(self.root + '/'):
+            raise IOError('%s is not in %s' % (path, self.root))
+        return path[len(self.root) + 1:].rstrip('/')
+
+    def join(self, *paths):
+        return '/'.join(path.rstrip('/') for path in paths)
+
+    def open(self, filename):
+        # Members can't be seeked
+        return io.BytesIO(self.read(filename))
+
+    def isfile(self, path):
+        try:
+            return self._member(path) in self._files
+        except IOError:
+            return False
+
+    def isdir(self, path):
+        try:
+            member = self._member(path)
+        except IOError:
+            return False
+        return member == '' or member in self._dirs
+
+    def listdir(self, path):
+        member = self._member(path)
+        prefix = member + '/' if member else ''
+        names = set()
+        for name in self._names:
+            if name.startswith(prefix):
+                names.add(name[len(prefix):].split('/')[0])
+        if not names and not self.isdir(path):
+            raise OSError('No such directory: %s' % path)
+        return sorted(names)
+
+    def walk_files(self, path):
+        """Return the list of all the files under path"""
+        member = self._member(path)
+        prefix = member + '/' if member else ''
+        return [self.join(self.root, name) for name in self._names
+                if name.startswith(prefix)]
+
+
+class ZipSource(_MemberSource):
+    """Files of a zip archive
+
+    The path of a member is the archive path followed by the member name
+    (like /tmp/plugin.foo.zip/plugin.foo/addon.xml).
+    """
+
+    is_archive = True
+
+    def __init__(self, zip_path):
+        self.zip_path = self.root = zip_path
+        self._zip_file = zipfile.ZipFile(zip_path)
+        self._set_names([name for name in self._zip_file.namelist()
+                         if not name.endswith('/')])
+
+    def __getstate__(self):
+        # ZipFile can't be pickled (used by pools of processes)
+        return self.zip_path
+
+    def __setstate__(self, zip_path):
+        self.__init__(zip_path)
+
+    def read(self, filename):
+        try:
+            data = self._zip_file.read(self._member(filename))
+        except KeyError:
+            raise IOError('No such file: %s' % filename)
+        profiler.count_read(len(data))
+        return data
+
+    def get_file_keys(self, filenames):
+        """Return the identifiers of the content of the files without
+        reading them
+
+        The size and CRC-32 stored in the directory of the archive.
+        """
+        keys = []
+        for filename in filenames:
+            try:
+                info = self._zip_file.getinfo(self._member(filename))
+            except KeyError:
+                raise IOError('No such file: %s' % filename)
+            keys.append([info.file_size, info.CRC])
+        return keys
+
+    def extract(self, path, dest_dir):
+        """Extract the archive in dest_dir and return the extracted path"""
+        logger.debug('Extracting %s in %s', self.zip_path, dest_dir)
+        self._zip_file.extractall(dest_dir)
+        member = self._member(path)
+        return os.path.join(dest_dir, *member.split('/')) if member else dest_dir
+
+
+class GitSource(_MemberSource):
+    """Files of a revision of a local git repository
+
+    The files are read from the git objects with a persistent git cat-file
+    process: the revision doesn't have to be checked out. The path of a
+    file is the repository path and the revision followed by the file name
+    in the repository (like /tmp/plugins:frodo/plugin.foo/addon.xml).
+    """
+
+    is_archive = False
+
+    def __init__(self, repo_path, ref, commit=None):
+        self.repo_path = repo_path
+        self.ref = ref
+        self.root = '%s:%s' % (repo_path, ref)
+        repo = gitrepo.GitRepo(repo_path)
+        if commit is None:
+            commit = repo.git('rev-parse -q --verify %s^{commit}' % ref,
+                              ignore_errors=True)
+            if not commit:
+                raise IOError('Unknown revision %s in %s' % (ref, repo_path))
+        self.commit = commit
+        # Blob sha1 of the files (submodules are ignored)
+        self._blobs = dict((name, sha) for mode, obj_type, sha, name
+                           in repo.ls_tree(commit, recursive=True)
+                           if obj_type == 'blob')
+        self._set_names(sorted(self._blobs))
+        self._cat_file = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # The cat-file process can't be pickled (used by pools of processes)
+        return (self.repo_path, self.ref, self.commit)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _get_cat_file(self):
+        with self._lock:
+            if self._cat_file is None:
+                self._cat_file = gitrepo.CatFile(self.repo_path)
+            return self._cat_file
+
+    def blob_sha(self, filename):
+        """Return the git blob sha1 of filename"""
+        try:
+            return self._blobs[self._member(filename)]
+        except KeyError:
+            raise IOError('No such file: %s' % filename)
+
+    def get_file_keys(self, filenames):
+        """Return the identifiers of the content of the files without
+        reading them
+
+        The git blob sha1 of the files.
+        """
+        return [self.blob_sha(filename) for filename in filenames]
+
+    def read(self, filename):
+        obj = self._get_cat_file().get(self.blob_sha(filename))
+        if obj is None:
+            raise IOError('Missing object of %s' % filename)
+        data = obj[1]
+        profiler.count_read(len(data))
+        return data
+
+    def close(self):
+        """Stop the cat-file process"""
+        with self._lock:
+            if self._cat_file is not None:
+                self._cat_file.close()
+                self._cat_file = None
+
+
+# GitSource of each (repository, revision) used by this process
+_git_sources = {}
+_git_sources_lock = threading.Lock()
+
+
+def find_git_repo(path):
+    """Return the (repository path, path in the repository) of path
+
+    path doesn't have to exist in the working tree.
+    Raise IOError if path is not in a git repository.
+    """
+    head = os.path.abspath(path)
+    names = []
+    while not os.path.exists(os.path.join(head, '.git')):
+        head, name = os.path.split(head)
+        if not name:
+            raise IOError('%s is not in a git repository' % path)
+        names.insert(0, name)
+    return head, '/'.join(names)
+
+
+def get_git_source(path, ref):
+    """Return the (GitSource, path in the source) of path at the revision ref
+
+    path is a path of a local git repository. The GitSource of each
+    repository and revision is created once per process.
+    """
+    repo_path, name = find_git_repo(path)
+    with _git_sources_lock:
+        try:
+            source = _git_sources[(repo_path, ref)]
+        except KeyError:
+            source = _git_sources[(repo_path, ref)] = GitSource(repo_path, ref)
+    return source, source.join(source.root, name) if name else source.root
@@ -22,15 +22,251 @@ addonpr utils module
 This module defines some utility functions.
 """
 import os
+import time
 import ConfigParser
 import logging
-from addonpr import command, addonparser
+import multiprocessing
+from datetime import datetime, timedelta
+from addonpr import (command, addonparser, addonindex, cache, gitrepo,
+                     profiler, depgraph, sources, watcher)
 
 
 logger = logging.getLogger(__name__)
 
 
+class RecordsHandler(logging.Handler):
+    """Logging handler keeping the records to replay them later"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Format the message now: arguments might not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+_records_handler = None
+
+
+def init_worker(level, profile=False):
+    """Capture the logs (and the profile) of the worker process"""
+    global _records_handler
+    _records_handler = RecordsHandler()
+    root = logging.getLogger()
+    root.handlers = [_records_handler]
+    root.setLevel(level)
+    if profile:
+        profiler.enable()
+
+
+def call_recorded(func, *args):
+    """Call func in a worker process initialized by init_worker
+
+    Return the result of func with the logs and the profile records
+    """
+    del _records_handler.records[:]
+    result = func(*args)
+    worker_profiler = profiler.get_profiler()
+    profile = worker_profiler.pop_records() if worker_profiler else []
+    return result, _records_handler.records, profile
+
+
+def _check_addon(args):
+    """Run the checks in a worker process
+
+    Return the result with the logs and the profile records
+    """
+    (warnings, errors), records, profile = call_recorded(run_check, *args)
+    return warnings, errors, records, profile
+
+
+def run_check(addon_path, xbmc_branch, result_cache=None, git_ref=None):
+    """Run the checks on addon_path and return the numbers of warnings and errors
+
+    If git_ref is given, the addon is read from this revision of its git
+    repository (addon_path doesn't have to exist in the working tree)
+    """
+    try:
+        source = None
+        if git_ref is not None:
+            source, addon_path = sources.get_git_source(addon_path, git_ref)
+        addon_check = addonparser.AddonCheck(addon_path, xbmc_branch,
+                                             cache=result_cache,
+                                             incremental=True,
+                                             source=source)
+    except Exception as e:
+        logging.error(e)
+        return (0, 1)
+    return addon_check.run()
+
+
+def find_addons(path, source=None):
+    """Return the list of addons in path
+
+    path can be an addon directory or a directory including several addons
+    (like a clone of the plugins or scripts repository)
+    """
+    source = source or sources.DirSource()
+    if not source.isdir(path) or source.isfile(source.join(path, 'addon.xml')):
+        return [path]
+    addon_paths = [source.join(path, name) for name in sorted(source.listdir(path))
+                   if not name.startswith('.') and
+                   source.isfile(source.join(path, name, 'addon.xml'))]
+    # Let the check report the error if no addon was found
+    return addon_paths or [path]
+
+
+def check_addons(conf, addon_path, xbmc_branch, jobs=None, clear_cache=False,
+                 git_ref=None):
+    """Run the checks on all the given addons using a pool of processes
+
+    If git_ref is given, the addons are read from this revision of their
+    git repository (without checking it out).
+    Return the total numbers of warnings and errors
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.expanduser(conf))
+    result_cache = cache.get_cache(config, clear_cache)
+    addon_paths = []
+    for addon_dir in addon_path:
+        if git_ref is None:
+            addon_paths.extend(find_addons(addon_dir))
+            continue
+        # Paths of the working tree (the GitSource is created by run_check)
+        try:
+            source, path = sources.get_git_source(addon_dir, git_ref)
+        except IOError:
+            # Reported by run_check
+            addon_paths.append(addon_dir)
+            continue
+        for found in find_addons(path, source):
+            name = found[len(path) + 1:]
+            addon_paths.append(os.path.join(addon_dir, name) if name else addon_dir)
+    jobs = int(jobs) if jobs else multiprocessing.cpu_count()
+    jobs = min(jobs, len(addon_paths))
+    tasks = [(path, xbmc_branch, result_cache, git_ref) for path in addon_paths]
+    total_warnings = total_errors = 0
+    if jobs <= 1:
+        for task in tasks:
+            warnings, errors = run_check(*task)
+            total_warnings += warnings
+            total_errors += errors
+    else:
+        main_profiler = profiler.get_profiler()
+        pool = multiprocessing.Pool(jobs, init_worker,
+                                    (logging.getLogger().getEffectiveLevel(),
+                                     main_profiler is not None))
+        try:
+            # imap keeps the order so that logs of each addon are
+            # replayed together
+            for warnings, errors, records, profile in pool.imap(_check_addon,
+                                                                tasks):
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if main_profiler is not None:
+                    main_profiler.add_records(profile)
+                total_warnings += warnings
+                total_errors += errors
+        finally:
+            pool.terminate()
+            pool.join()
+    if len(tasks) > 1:
+        logger.info('%d addons checked: %d warning(s) and %d error(s) found',
+                    len(tasks), total_warnings, total_errors)
+    return (total_warnings, total_errors)
+
+
+def _run_recorded_check(addon_path, xbmc_branch):
+    """Run the checks on addon_path and return the AddonCheck (None on error)"""
+    try:
+        addon_check = addonparser.AddonCheck(addon_path, xbmc_branch)
+        addon_check.run_recorded()
+    except Exception as e:
+        logging.error(e)
+        return None
+    return addon_check
+
+
+def watch_addons(addon_path, xbmc_branch):
+    """Check the addon directories and check them again when they change
+
+    The findings of the checks are kept in memory: only the checks of the
+    changed files (and the addon checks if the addon.xml changed) are run
+    again. Run until interrupted.
+    """
+    addon_paths = [path for addon_dir in addon_path
+                   for path in find_addons(addon_dir)]
+    for path in addon_paths:
+        if not os.path.isdir(path):
+            logger.error('Only directories can be watched: %s', path)
+            return
+    checks = dict((path, _run_recorded_check(path, xbmc_branch))
+                  for path in addon_paths)
+    file_watcher = watcher.get_watcher(addon_paths)
+    logger.info('Watching %d addon(s) (Ctrl-C to stop)', len(addon_paths))
+    try:
+        while True:
+            changed = file_watcher.wait()
+            start = time.time()
+            for path in addon_paths:
+                prefix = os.path.join(path, '')
+                paths = set(filename for filename in changed
+                            if filename.startswith(prefix) or filename == path)
+                if not paths:
+                    continue
+                logger.debug('Changed: %s', ', '.join(sorted(paths)))
+                addon_check = checks[path]
+                if addon_check is None:
+                    checks[path] = _run_recorded_check(path, xbmc_branch)
+                    continue
+                try:
+                    addon_check.recheck(paths)
+                except Exception as e:
+                    logging.error(e)
+                    # Checked from scratch after the next change
+                    checks[path] = None
+            logger.info('Checked again in %.3fs', time.time() - start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        file_watcher.close()
+
+
+def check_dependency_graph(conf, xbmc_branch):
+    """Check the dependencies of all the addons of the branch
+
+    The addons of the plugins, scripts, scrapers and skins repositories
+    of the git parent dir are loaded in a single dependency graph.
+    Return the numbers of warnings and errors.
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.expanduser(conf))
+    try:
+        git_parent_dir = config.get('git', 'parent_dir')
+    except ConfigParser.NoSectionError:
+        logger.warning('No git parent_dir defined. Using "."')
+        git_parent_dir = '.'
+    result_cache = cache.get_cache(config)
+    graph = depgraph.DependencyGraph(xbmc_branch)
+    for repo in depgraph.REPOSITORIES:
+        repo_path = os.path.join(git_parent_dir, repo)
+        if os.path.isdir(repo_path):
+            graph.add_repository(repo_path, result_cache)
+        else:
+            logger.debug('Skipping %s (no such directory)', repo_path)
+    return graph.check()
+
+
 def clean_repo(conf, xbmc_branch, addon_type):
+    """Remove the addons of the repository broken for more than 6 months
+
+    The branch is not checked out: the addons are read from the branch
+    index and all the removals are committed at once.
+    """
     config = ConfigParser.ConfigParser()
     config.read(os.path.expanduser(conf))
     try:
@@ -40,16 +276,34 @@ def clean_repo(conf, xbmc_branch, addon_type):
         repo = "."
     else:
         repo = os.path.join(git_parent_dir, addon_type)
-    os.chdir(repo)
-    command.run('git checkout -qf %s' % xbmc_branch)
-    for addon_path in os.listdir("."):
-        if addon_path.startswith("."):
-            continue
-        addon = addonparser.Addon(addon_path)
-        if addon.is_broken():
-            logging.debug("{} is broken".format(addon.addon_id))
-            if addon.is_last_commit_older_than(days=182):
-                logging.info("Removing {} (broken for more than 6 months)".format(addon.addon_id))
-                command.run('git rm -rf {}'.format(addon.addon_id))
-                msg = '[%s] removed (broken for more than 6 months)' % addon.addon_id
-                command.run('git commit -m "%s"' % msg)
+    index = addonindex.get_index(repo, xbmc_branch, cache.get_cache(config))
+    broken = sorted(name for name, info in index.addons.items()
+                    if info is not None and info['broken'])
+    git_repo = gitrepo.GitRepo(repo)
+    dates = git_repo.last_commit_dates('refs/heads/%s' % xbmc_branch,
+                                       [name + '/addon.xml' for name in broken])
+    limit = datetime.now() - timedelta(days=182)
+    removed = []
+    for name in broken:
+        addon_id = index.get(name)['id']
+        logging.debug("{} is broken".format(addon_id))
+        timestamp = dates.get(name + '/addon.xml')
+        if timestamp is not None and datetime.fromtimestamp(timestamp) < limit:
+            logging.info("Removing {} (broken for more than 6 months)".format(addon_id))
+            removed.append((name, addon_id))
+    if not removed:
+        return
+    messages = ['[%s] removed (broken for more than 6 months)' % addon_id
+                for name, addon_id in removed]
+    if len(messages) == 1:
+        msg = messages[0]
+    else:
+        msg = 'Remove %d addons broken for more than 6 months\n\n%s' % (
+            len(messages), '\n'.join(messages))
+    with command.git_lock:
+        builder = gitrepo.CommitBuilder(git_repo, xbmc_branch)
+        try:
+            builder.remove([name for name, addon_id in removed])
+            builder.commit(msg)
+        finally:
+            builder.close()
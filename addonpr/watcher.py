@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+addonpr watcher module
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+This module defines watchers of the changes in directory trees
+(used by --check --watch). inotify is used on Linux (through ctypes).
+Other platforms fall back to polling the files modification times.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# inotify events (see inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+# Header of the inotify events: wd, mask, cookie, len (followed by the name)
+EVENT_HEADER = struct.Struct('iIII')
+# Time without new event after which the changes are returned (an editor
+# saving a file usually generates several events)
+SETTLE_TIME = 0.05
+
+
+def get_watcher(paths, interval=1):
+    """Return a watcher of the directory trees paths
+
+    Use inotify if available. Otherwise poll every interval seconds.
+    """
+    try:
+        return InotifyWatcher(paths)
+    except OSError as e:
+        logger.debug('inotify not available (%s): polling', e)
+        return PollingWatcher(paths, interval)
+
+
+def _walk_dirs(path):
+    """Return the list of the directories under path (included)"""
+    return [root for root, dirs, files in os.walk(path)]
+
+
+class InotifyWatcher(object):
+    """Watch directory trees with inotify
+
+    Raise OSError if inotify is not available.
+    """
+
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            inotify_init = libc.inotify_init
+        except AttributeError:
+            raise OSError('inotify not supported')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # {watch descriptor: directory}
+        self._dirs = {}
+        for path in paths:
+            self._add_tree(path)
+
+    def _add_tree(self, path):
+        for dirname in _walk_dirs(path):
+            wd = self._add_watch(self.fd, dirname, WATCH_MASK)
+            if wd < 0:
+                logger.warning("Can't watch %s: %s", dirname,
+                               os.strerror(ctypes.get_errno()))
+            else:
+                self._dirs[wd] = dirname
+
+    def _read_events(self):
+        """Return the set of paths of the pending events"""
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return set()
+            raise
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            dirname = self._dirs.get(wd)
+            if dirname is None:
+                continue
+            path = os.path.join(dirname, name) if name else dirname
+            paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files might be created before the directory is watched
+                self._add_tree(path)
+                paths.update(os.path.join(root, filename)
+                             for root, dirs, files in os.walk(path)
+                             for filename in files)
+        return paths
+
+    def wait(self, timeout=None):
+        """Wait for changes and return the set of paths changed
+
+        Return an empty set after timeout seconds without change.
+        """
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if not readable:
+            return set()
+        paths = self._read_events()
+        # Wait for the changes to settle
+        while select.select([self.fd], [], [], SETTLE_TIME)[0]:
+            paths.update(self._read_events())
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Watch directory trees by polling the files modification times"""
+
+    def __init__(self, paths, interval=1):
+        self.paths = paths
+        self.interval = interval
+        self._state = self._get_state()
+
+    def _get_state(self):
+        """Return {path: (modification time, size)} of the files"""
+        state = {}
+        for path in self.paths:
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    filename = os.path.join(root, name)
+                    try:
+                        info = os.stat(filename)
+                    except OSError:
+                        continue
+                    state[filename] = (info.st_mtime, info.st_size)
+        return state
+
+    def wait(self, timeout=None):
+        """Wait for changes and return the set of paths changed
+
+        Return an empty set after timeout seconds without change.
+        """
+        start = time.time()
+        while True:
+            state = self._get_state()
+            paths = set(filename for filename in set(state) | set(self._state)
+                        if state.get(filename) != self._state.get(filename))
+            self._state = state
+            if paths:
+                return paths
+            if timeout is not None and time.time() - start >= timeout:
+                return set()
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Generator of synthetic addon trees for the benchmarks
+
+The addons have the shape of a plugin, a script or a skin (the addon
+type returned by Addon._get_addon_type) and a configurable number of
+python files, languages (strings.po), xml files and images.
+The content only depends on the parameters and the seed.
+"""
+import os
+import random
+from PIL import Image
+
+
+SHAPES = ('plugin', 'script', 'skin')
+# Number of files of each kind per tree size
+SIZES = {'small': {'py_files': 10, 'languages': 3, 'xml_files': 5, 'images': 5},
+         'medium': {'py_files': 50, 'languages': 10, 'xml_files': 20, 'images': 30},
+         'large': {'py_files': 200, 'languages': 30, 'xml_files': 60, 'images': 100}}
+LANGUAGES = ['English', 'French', 'German', 'Spanish', 'Italian', 'Dutch',
+             'Portuguese', 'Swedish', 'Polish', 'Chinese (Simple)']
+# (addon id, extension point, directory of the xml files, of the images)
+ADDON_SHAPES = {
+    'plugin': ('plugin.video.benchmark', 'xbmc.python.pluginsource',
+               os.path.join('resources', 'skins', 'Default', '720p'),
+               os.path.join('resources', 'media')),
+    'script': ('script.benchmark', 'xbmc.python.script',
+               os.path.join('resources', 'skins', 'Default', '720p'),
+               os.path.join('resources', 'media')),
+    'skin': ('skin.benchmark', 'xbmc.gui.skin', '720p', 'media'),
+    }
+STRINGS_START = {'plugin': 30000, 'script': 32000, 'skin': 31000}
+
+ADDON_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<addon id="%(addon_id)s" name="Benchmark" version="1.0.0" provider-name="addon-pr">
+  <requires>
+    <import addon="xbmc.python" version="2.1.0"/>
+    <import addon="xbmc.gui" version="4.0.0"/>
+    <import addon="script.module.simplejson" version="2.0.10"/>
+  </requires>
+  <extension point="%(point)s" library="default.py">
+    <provides>video</provides>
+  </extension>
+  <extension point="xbmc.addon.metadata">
+%(metadata)s    <language>en</language>
+    <platform>all</platform>
+    <license>GNU GENERAL PUBLIC LICENSE. Version 2, June 1991</license>
+    <forum>http://forum.xbmc.org</forum>
+    <website>http://xbmc.org</website>
+    <source>https://github.com/xbmc/benchmark</source>
+    <email>benchmark@xbmc.org</email>
+  </extension>
+</addon>
+"""
+
+PY_LINES = ['import os',
+            'import sys',
+            '# Comment line',
+            'def function_%(n)d(value):',
+            '    """Docstring"""',
+            '    result = value * %(n)d',
+            '    xbmc.log("value %%s" %% result)',
+            '    return result',
+            '',
+            'class Class%(n)d(object):',
+            '    def method(self, path):',
+            '        return os.path.join(path, "file_%(n)d")',
+            '']
+# Lines triggering the checks (one of them every few lines)
+PY_FINDINGS = ['    print "debug"',
+               '    path = os.getcwd()',
+               '    xbmc.executehttpapi("action")',
+               '    player = xbmc.PLAYER_CORE_MPLAYER']
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<window>\n  <controls>\n'
+XML_CONTROL = """    <control type="button" id="%(n)d">
+      <posx>%(x)d</posx>
+      <posy>%(y)d</posy>
+      <label>$LOCALIZE[%(string_id)d]</label>
+      <texturefocus>button-focus.png</texturefocus>
+    </control>
+"""
+XML_FOOTER = '  </controls>\n</window>\n'
+
+
+def _write(filename, data):
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+def _language_names(count):
+    names = []
+    for i in range(count):
+        name = LANGUAGES[i % len(LANGUAGES)]
+        if i >= len(LANGUAGES):
+            name = '%s%d' % (name, i // len(LANGUAGES))
+        names.append(name)
+    return names
+
+
+def _metadata(languages):
+    lines = []
+    for name in languages:
+        lang = name[:2].lower()
+        lines.append('    <summary lang="%s">Benchmark addon</summary>\n' % lang)
+        lines.append('    <description lang="%s">Addon generated to benchmark '
+                     'addon-pr</description>\n' % lang)
+    return ''.join(lines)
+
+
+def _python_file(rand, lines):
+    data = []
+    for n in range(lines // len(PY_LINES) + 1):
+        data.extend(line % {'n': n} for line in PY_LINES)
+        if rand.random() < 0.2:
+            data.insert(-2, rand.choice(PY_FINDINGS))
+    return '\n'.join(data[:lines]) + '\n'
+
+
+def _po_file(start, count):
+    data = ['# Benchmark language file', 'msgid ""', 'msgstr ""', '']
+    for string_id in range(start, start + count):
+        data.extend(['msgctxt "#%d"' % string_id,
+                     'msgid "String %d"' % string_id,
+                     'msgstr "String %d"' % string_id,
+                     ''])
+    return '\n'.join(data)
+
+
+def _strings_xml(start, count):
+    data = ['<?xml version="1.0" encoding="utf-8" standalone="yes"?>', '<strings>']
+    data.extend('  <string id="%d">String %d</string>' % (string_id, string_id)
+                for string_id in range(start, start + count))
+    data.append('</strings>\n')
+    return '\n'.join(data)
+
+
+def _xml_file(rand, controls, start):
+    data = [XML_HEADER]
+    for n in range(controls):
+        data.append(XML_CONTROL % {'n': n, 'x': rand.randint(0, 1280),
+                                   'y': rand.randint(0, 720),
+                                   'string_id': start + n})
+    data.append(XML_FOOTER)
+    return ''.join(data)
+
+
+def _image(filename, size, color):
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    image = Image.new('RGB', size, color)
+    if filename.endswith('.jpg'):
+        image.save(filename, 'JPEG')
+    else:
+        image.save(filename, 'PNG')
+
+
+def create_addon(parent_dir, shape='plugin', py_files=50, languages=10,
+                 xml_files=20, images=30, py_lines=200, strings=200, seed=0):
+    """Create a synthetic addon in parent_dir and return its path"""
+    rand = random.Random(seed)
+    addon_id, point, xml_dir, media_dir = ADDON_SHAPES[shape]
+    addon_path = os.path.join(parent_dir, addon_id)
+    language_names = _language_names(languages)
+    _write(os.path.join(addon_path, 'addon.xml'),
+           ADDON_XML % {'addon_id': addon_id, 'point': point,
+                        'metadata': _metadata(language_names)})
+    _write(os.path.join(addon_path, 'LICENSE.txt'), 'GPLv2\n' * 100)
+    _write(os.path.join(addon_path, 'changelog.txt'), '[B]1.0.0[/B]\n- Initial version\n')
+    _image(os.path.join(addon_path, 'icon.png'), (256, 256), (0, 0, 128))
+    _image(os.path.join(addon_path, 'fanart.jpg'), (1280, 720), (0, 128, 0))
+    if shape != 'skin':
+        _write(os.path.join(addon_path, 'default.py'), _python_file(rand, py_lines))
+    for n in range(py_files):
+        _write(os.path.join(addon_path, 'resources', 'lib', 'module%d.py' % n),
+               _python_file(rand, py_lines))
+    start = STRINGS_START[shape]
+    for name in language_names:
+        language_dir = os.path.join(addon_path, 'resources', 'language', name)
+        _write(os.path.join(language_dir, 'strings.po'), _po_file(start, strings))
+    if language_names:
+        _write(os.path.join(addon_path, 'resources', 'language', language_names[0],
+                            'strings.xml'), _strings_xml(start, strings))
+    for n in range(xml_files):
+        _write(os.path.join(addon_path, xml_dir, 'Window%d.xml' % n),
+               _xml_file(rand, 50, start))
+    for n in range(images):
+        extension = '.png' if n % 3 else '.jpg'
+        size = (rand.choice([64, 128, 256, 512]), rand.choice([64, 128, 256, 512]))
+        color = (rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255))
+        _image(os.path.join(addon_path, media_dir, 'image%d%s' % (n, extension)),
+               size, color)
+    return addon_path
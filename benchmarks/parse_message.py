@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the parsing of the pull request messages
+
+messageparser.find_addon_blocks returns the same blocks as the regex
+previously used (ADDON_RE of tests/test_messageparser.py, which compares
+both on a corpus of generated messages). This script times both on
+adversarial messages.
+The regex is only run on adversarial messages as long as it takes less
+than --max_time seconds (its time grows polynomially).
+
+Usage:
+  parse_message.py [--max_time=<SECONDS>]
+  parse_message.py (-h | --help)
+
+Options:
+  -h --help              Show this screen
+  --max_time=<SECONDS>   Maximum time of a regex run [default: 1]
+"""
+import os
+import sys
+import time
+from docopt import docopt
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+from addonpr.messageparser import find_addon_blocks
+from test_messageparser import ADDON_RE
+
+
+def adversarial_messages():
+    """Generate (name, message): blocks without xbmc version and long gaps"""
+    block = ('addon: plugin.video.m6groupe\nversion: 1.0.2\n'
+             'url: git://github.com/beenje/plugin.video.m6groupe.git\n'
+             'revision: v1.0.2\nxbmc version: eden, frodo\n\n')
+    yield 'typical message (3 blocks)', 'Hi,\n\n%sThanks\n' % (block * 3)
+    for gap in (10, 20, 30, 40, 50, 1000, 100000):
+        separator = '\n' * gap
+        yield ('%d blank lines between fields' % gap,
+               separator.join(['addon: plugin.video.foo', 'version: 1.0',
+                               'url: git://github.com/foo/bar.git',
+                               'branch: master', 'xbmc: frodo\n']))
+    for size in (100, 1000, 10000, 1000000):
+        yield ('%d dashes' % size,
+               'addon:%s\nversion:%s\nurl:%s\n' % ('-' * size, '-' * size, '-' * size))
+    for count in (10, 100, 1000, 10000):
+        yield ('%d incomplete blocks' % count,
+               'addon: foo\n\nversion: 1\n\n\n' * count)
+    for count in (10, 100, 300, 16000):
+        # Each line end of the separators is a possible end of the branch
+        # (the branch line is made of 2 * count dashes)
+        yield ('%d line ends after a branch line' % count,
+               'addon: plugin.video.foo\nversion: 1.0\n'
+               'url: git://github.com/foo/bar.git\nbranch:%s%s' % (
+                   '-' * 2 * count, ' \n' * count))
+    for count in (1000, 2000, 4000, 16000):
+        # Each branch keyword is reached by an end of the revision value
+        # (the separators of the revision continue on the next line)
+        yield ('%d branch keywords after a revision' % count,
+               'addon: plugin.video.foo\nversion: 1.0\n'
+               'url: git://github.com/foo/bar.git\nrevision:%s\n%s' % (
+                   '-' * count, 'branch' * count))
+
+
+def timed(func, message):
+    start = time.time()
+    func(message)
+    return time.time() - start
+
+
+def benchmark(max_time):
+    print '%-40s %10s %10s' % ('Message', 'regex (s)', 'parser (s)')
+    regex_too_slow = set()
+    for name, message in adversarial_messages():
+        kind = name.split(' ', 1)[1]
+        if kind in regex_too_slow:
+            regex_time = '-'
+        else:
+            duration = timed(ADDON_RE.findall, message)
+            if duration > max_time:
+                regex_too_slow.add(kind)
+            regex_time = '%.4f' % duration
+        print '%-40s %10s %10.4f' % (name, regex_time, timed(find_addon_blocks, message))
+
+
+def main():
+    arguments = docopt(__doc__)
+    benchmark(float(arguments['--max_time']))
+
+
+if __name__ == '__main__':
+    main()
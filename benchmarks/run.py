@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of the hot paths of addon-pr
+
+Synthetic addon trees (plugin, script and skin) are generated to time
+AddonCheck.run, each check, the single pass over the files, the addon.xml
+parsing and the AddonVersion comparison. parse_message is timed on
+generated message corpora.
+
+The results can be written to a JSON file and compared to the output of
+another commit: benchmarks slower than the threshold ratio are reported
+as regressions (and the exit status is 1).
+
+Usage:
+  run.py [options]
+  run.py (-h | --help)
+
+Options:
+  -h --help              Show this screen
+  --output=<FILE>        Write the results to FILE
+  --compare=<FILE>       Compare the results to a previous output
+  --size=<SIZE>          Size of the addon trees: small, medium or large
+                         [default: medium]
+  --repeat=<N>           Number of measures of each benchmark [default: 5]
+  --threshold=<RATIO>    Slowdown ratio of a regression [default: 1.2]
+  --filter=<TEXT>        Only run the benchmarks whose name includes TEXT
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from docopt import docopt
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+import addonpr
+from addonpr import addonparser, pullrequest
+import addontree
+import parse_message
+import test_messageparser
+
+
+class Benchmarks(object):
+    """Run the benchmarks and collect the results
+
+    Each measure calls setup (if any) then times func(setup result)
+    number times. The minimum and median of the measures are kept
+    (in seconds per call).
+    """
+
+    def __init__(self, repeat, name_filter=None):
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.results = {}
+
+    def measure(self, name, func, setup=None, number=1):
+        """Time func and return its last result"""
+        if self.name_filter and self.name_filter not in name:
+            return None
+        times = []
+        for i in range(self.repeat):
+            arg = setup() if setup is not None else None
+            start = time.time()
+            for j in xrange(number):
+                result = func(arg)
+            times.append((time.time() - start) / number)
+        times.sort()
+        self.results[name] = {'min': times[0],
+                              'median': times[len(times) // 2],
+                              'number': number}
+        print '%-55s %10.6f %10.6f' % (name, times[0], times[len(times) // 2])
+        return result
+
+
+def run_check(addon_check, name):
+    """Run the check name alone (file checks included)"""
+    method = getattr(addon_check, name)
+    if not hasattr(method, 'visitor'):
+        method()
+        return
+    for filename in addon_check.files:
+        if filename.endswith(method.suffixes):
+            method.visitor(addon_check, addon_check.get_source(filename))
+
+
+def benchmark_addon(benchmarks, addon_path, shape):
+    def new_check(arg=None):
+        return addonparser.AddonCheck(addon_path, 'frodo')
+
+    name = 'run/%s' % shape
+    result = benchmarks.measure(name, lambda check: check.run(), new_check)
+    if result is not None:
+        # Number of warnings and errors (to compare the behaviour as well)
+        benchmarks.results[name]['result'] = list(result)
+    benchmarks.measure('scan_files/%s' % shape, lambda check: check.scan_files(),
+                       new_check)
+    for name in sorted(dir(addonparser.AddonCheck)):
+        if name.startswith('check_'):
+            benchmarks.measure('check/%s/%s' % (shape, name),
+                               lambda check, name=name: run_check(check, name),
+                               new_check)
+    benchmarks.measure('addon/parse/%s' % shape,
+                       lambda arg: addonparser.Addon(addon_path), number=100)
+
+
+def benchmark_versions(benchmarks):
+    rand = random.Random(0)
+    vstrings = ['%d.%d.%d' % (rand.randint(0, 20), rand.randint(0, 20),
+                              rand.randint(0, 20)) for i in range(1000)]
+    versions = [addonparser.AddonVersion(vstring) for vstring in vstrings]
+    benchmarks.measure('addon_version/parse',
+                       lambda arg: [addonparser.AddonVersion(v) for v in vstrings])
+    benchmarks.measure('addon_version/sort', lambda arg: sorted(versions))
+    # Versions of the dependencies are strings
+    benchmarks.measure('addon_version/compare_str',
+                       lambda arg: [v > s for v, s in zip(versions, vstrings[::-1])])
+
+
+def benchmark_messages(benchmarks):
+    subject = '[git pull] plugin.video.benchmark'
+    rand = random.Random(0)
+    corpus = [test_messageparser.generate_message(rand) for i in range(1000)]
+    # The first adversarial message is a typical one
+    messages = [('typical', next(parse_message.adversarial_messages())[1]),
+                ('corpus', corpus)]
+    for name, message in parse_message.adversarial_messages():
+        if name in ('40 blank lines between fields', '10000 dashes',
+                    '1000 incomplete blocks',
+                    '16000 line ends after a branch line',
+                    '16000 branch keywords after a revision'):
+            messages.append((name.replace(' ', '_'), message))
+    for name, message in messages:
+        if isinstance(message, list):
+            func = lambda arg, corpus=message: [
+                pullrequest.parse_message(subject, text) for text in corpus]
+        else:
+            func = lambda arg, text=message: pullrequest.parse_message(subject, text)
+        benchmarks.measure('parse_message/%s' % name, func)
+
+
+def get_commit():
+    """Return the current commit of the repository (None if unknown)"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, filename, threshold):
+    """Print the ratios to the previous results and return the regressions"""
+    with open(filename, 'rb') as f:
+        previous = json.load(f)
+    print
+    print 'Comparison to %s (commit %s)' % (filename, previous.get('commit'))
+    regressions = []
+    for name in sorted(results['benchmarks']):
+        if name not in previous['benchmarks']:
+            continue
+        current, before = results['benchmarks'][name], previous['benchmarks'][name]
+        ratio = current['min'] / max(before['min'], 1e-9)
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = 'REGRESSION'
+        if current.get('result') != before.get('result'):
+            flag += ' (result %s != %s)' % (current.get('result'), before.get('result'))
+        print '%-55s %8.2fx %s' % (name, ratio, flag)
+    print '%d regression(s)' % len(regressions)
+    return regressions
+
+
+def main():
+    arguments = docopt(__doc__)
+    size = arguments['--size']
+    if size not in addontree.SIZES:
+        sys.exit('Invalid size: %s' % size)
+    # Warnings of the checks are expected
+    logging.disable(logging.CRITICAL)
+    benchmarks = Benchmarks(int(arguments['--repeat']), arguments['--filter'])
+    print '%-55s %10s %10s' % ('Benchmark', 'min (s)', 'median (s)')
+    tmp_dir = tempfile.mkdtemp(prefix='addon-pr-benchmarks-')
+    try:
+        for shape in addontree.SHAPES:
+            addon_path = addontree.create_addon(tmp_dir, shape,
+                                                **addontree.SIZES[size])
+            benchmark_addon(benchmarks, addon_path, shape)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    benchmark_versions(benchmarks)
+    benchmark_messages(benchmarks)
+    results = {'version': addonpr.__version__,
+               'commit': get_commit(),
+               'python': platform.python_version(),
+               'size': size,
+               'repeat': benchmarks.repeat,
+               'benchmarks': benchmarks.results}
+    if arguments['--output']:
+        with open(arguments['--output'], 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if arguments['--compare']:
+        if compare(results, arguments['--compare'], float(arguments['--threshold'])):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
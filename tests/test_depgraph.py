@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the dependency graph of the addons of a branch
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+find_cycles is compared with a brute force search of the strongly
+connected components on random graphs. The addons of the graph are set
+directly (as read from the indexes of the repositories).
+Run with: python -m unittest discover tests
+"""
+import random
+import logging
+import unittest
+from addonpr import depgraph
+
+
+def reachable(edges, node):
+    """Return the set of the nodes reachable from node"""
+    seen = set()
+    todo = [node]
+    while todo:
+        for successor in edges.get(todo.pop(), ()):
+            if successor not in seen:
+                seen.add(successor)
+                todo.append(successor)
+    return seen
+
+
+def brute_force_cycles(edges):
+    """Return the sorted cycles of the graph (nodes reachable both ways)"""
+    reach = dict((node, reachable(edges, node)) for node in edges)
+    cycles = set()
+    for node in edges:
+        if node in reach[node]:
+            cycles.add(tuple(sorted(other for other in reach[node]
+                                    if node in reach.get(other, ()))))
+    return sorted(list(cycle) for cycle in cycles)
+
+
+def make_addon(addon_id, version='1.0.0', broken=False, *dependencies):
+    """Return the info of an addon (dependencies are (id, version, optional))"""
+    return {'id': addon_id, 'version': version, 'broken': broken,
+            'path': 'plugins/%s' % addon_id,
+            'dependencies': [dict(item for item in (
+                ('addon', dep_id), ('version', dep_version),
+                ('optional', optional)) if item[1] is not None)
+                for dep_id, dep_version, optional in dependencies]}
+
+
+class MessagesHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelname, record.getMessage()))
+
+
+class FindCyclesTestCase(unittest.TestCase):
+
+    def test_no_cycle(self):
+        self.assertEqual(depgraph.find_cycles({}), [])
+        self.assertEqual(depgraph.find_cycles(
+            {'a': ['b', 'c'], 'b': ['c'], 'c': []}), [])
+
+    def test_cycles(self):
+        self.assertEqual(depgraph.find_cycles(
+            {'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': ['a']}), [['a', 'b', 'c']])
+        self.assertEqual(sorted(depgraph.find_cycles(
+            {'a': ['b'], 'b': ['a', 'c'], 'c': ['d'], 'd': ['c'], 'e': []})),
+            [['a', 'b'], ['c', 'd']])
+
+    def test_self_loop(self):
+        self.assertEqual(depgraph.find_cycles({'a': ['a'], 'b': ['a']}),
+                         [['a']])
+
+    def test_missing_nodes(self):
+        # Successors are not always keys of the graph
+        self.assertEqual(depgraph.find_cycles(
+            {'a': ['b', 'x'], 'b': ['a', 'y']}), [['a', 'b']])
+
+    def test_random_graphs(self):
+        rand = random.Random(0)
+        for i in xrange(300):
+            nodes = range(rand.randint(1, 12))
+            density = rand.random() * 0.4
+            edges = dict((node, [other for other in nodes
+                                 if rand.random() < density])
+                         for node in nodes)
+            self.assertEqual(sorted(depgraph.find_cycles(edges)),
+                             brute_force_cycles(edges), edges)
+
+    def test_long_chain(self):
+        # The search is iterative: no recursion limit
+        edges = dict((node, [node + 1]) for node in xrange(10000))
+        edges[10000] = [0]
+        self.assertEqual(depgraph.find_cycles(edges), [range(10001)])
+
+
+class DependencyGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = MessagesHandler()
+        depgraph.logger.addHandler(self.handler)
+        self.level = depgraph.logger.level
+        depgraph.logger.setLevel(logging.DEBUG)
+        self.graph = depgraph.DependencyGraph('frodo')
+
+    def tearDown(self):
+        depgraph.logger.removeHandler(self.handler)
+        depgraph.logger.setLevel(self.level)
+
+    def check(self, *addons):
+        """Check the graph of the addons and return the warnings and errors"""
+        self.graph.addons = dict((addon['id'], addon) for addon in addons)
+        result = self.graph.check()
+        self.assertEqual(result, (
+            len([1 for level, _ in self.handler.messages if level == 'WARNING']),
+            len([1 for level, _ in self.handler.messages if level == 'ERROR'])))
+        return [message for message in self.handler.messages
+                if message[0] in ('WARNING', 'ERROR')]
+
+    def test_valid(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False,
+                       ('xbmc.python', '2.1.0', None),
+                       ('script.module.b', '1.2', None),
+                       ('script.module.c', None, None)),
+            make_addon('script.module.b', '1.2.0'),
+            make_addon('script.module.c')), [])
+        self.assertEqual(self.graph.edges['plugin.a'],
+                         ['script.module.b', 'script.module.c'])
+
+    def test_unresolved(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False,
+                       ('script.module.missing', None, None))),
+            [('WARNING', 'plugin.a: unresolved dependency script.module.missing')])
+
+    def test_optional(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False,
+                       ('script.module.missing', '1.0', 'true'))), [])
+        self.assertIn(('DEBUG', 'plugin.a: optional dependency '
+                                'script.module.missing not found'),
+                      self.handler.messages)
+
+    def test_broken(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False, ('script.module.b', None, None)),
+            make_addon('script.module.b', '1.0.0', True)),
+            [('WARNING', 'plugin.a: depends on the broken addon script.module.b')])
+
+    def test_version(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False, ('script.module.b', '2.0', None)),
+            make_addon('script.module.b', '1.9.9')),
+            [('ERROR', 'plugin.a: invalid version for script.module.b '
+                       '(2.0 > 1.9.9)')])
+
+    def test_xbmc_version(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False, ('xbmc.python', '2.0', None))),
+            [('ERROR', 'plugin.a: invalid version for xbmc.python '
+                       '(2.0 != 2.1.0)')])
+
+    def test_cycles(self):
+        self.assertEqual(self.check(
+            make_addon('plugin.a', '1.0.0', False, ('script.module.b', None, None)),
+            make_addon('script.module.b', '1.0.0', False,
+                       ('script.module.c', None, None)),
+            make_addon('script.module.c', '1.0.0', False,
+                       ('script.module.b', None, None)),
+            make_addon('script.module.d', '1.0.0', False,
+                       ('script.module.d', None, None))),
+            [('ERROR', 'Dependency cycle between script.module.b, '
+                       'script.module.c'),
+             ('ERROR', 'Dependency cycle between script.module.d')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the update of the addons in the local git repositories
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+GitRepo.update_dir (working tree) and CommitBuilder.replace_dir (git
+objects only) shall give the same tree as replacing the addon directory
+and staging it with git add -A.
+Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+from addonpr import gitrepo
+
+IDENTITY = {'GIT_AUTHOR_NAME': 'test', 'GIT_AUTHOR_EMAIL': 'test@xbmc.org',
+            'GIT_COMMITTER_NAME': 'test', 'GIT_COMMITTER_EMAIL': 'test@xbmc.org'}
+
+# Files of the committed addon: content, ('exec', content) or ('link', target)
+OLD_FILES = {'addon.xml': '<addon id="plugin.a" version="1.0"/>\n',
+             'unchanged.py': 'print "unchanged"\n',
+             'modified.py': 'print "old"\n',
+             'removed.py': 'print "removed"\n',
+             'empty_dir/removed.txt': 'removed with its directory\n',
+             'to_exec.sh': 'echo exec\n',
+             'from_exec.sh': ('exec', 'echo not exec\n'),
+             'link': ('link', 'unchanged.py'),
+             'retargeted_link': ('link', 'unchanged.py'),
+             'link_to_file': ('link', 'modified.py'),
+             'resources/lib/module.py': 'x = 1\n'}
+NEW_FILES = {'addon.xml': '<addon id="plugin.a" version="1.1"/>\n',
+             'unchanged.py': 'print "unchanged"\n',
+             'modified.py': 'print "new"\n',
+             'to_exec.sh': ('exec', 'echo exec\n'),
+             'from_exec.sh': 'echo not exec\n',
+             'link': ('link', 'unchanged.py'),
+             'retargeted_link': ('link', 'modified.py'),
+             'link_to_file': 'not a link anymore\n',
+             'added_link': ('link', 'resources/lib/module.py'),
+             'resources/lib/module.py': 'x = 2\n',
+             'resources/lib/added.py': 'y = 1\n',
+             'resources/ignored.pyc': 'ignored by the root .gitignore\n'}
+
+
+def make_files(path, files):
+    for name, content in files.items():
+        filename = os.path.join(path, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        kind = None
+        if isinstance(content, tuple):
+            kind, content = content
+        if kind == 'link':
+            os.symlink(content, filename)
+            continue
+        with open(filename, 'wb') as f:
+            f.write(content)
+        os.chmod(filename, 0755 if kind == 'exec' else 0644)
+
+
+class UpdateDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.update(IDENTITY)
+        self.repo_path = os.path.join(self.tmp_dir, 'plugins')
+        os.mkdir(self.repo_path)
+        self.git('init -q')
+        make_files(self.repo_path, {'.gitignore': '*.pyc\n',
+                                    'plugin.b/addon.xml': '<addon/>\n'})
+        make_files(os.path.join(self.repo_path, 'plugin.a'), OLD_FILES)
+        self.git('add -A')
+        self.git('commit -q -m initial')
+        self.git('branch frodo')
+        self.repo = gitrepo.GitRepo(self.repo_path)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def git(self, args):
+        return subprocess.check_output(['git'] + args.split(),
+                                       cwd=self.repo_path).strip()
+
+    def make_source(self, name):
+        source_dir = os.path.join(self.tmp_dir, name)
+        make_files(source_dir, NEW_FILES)
+        return source_dir
+
+    def get_expected_tree(self, branch):
+        """Return the tree of the new addon staged with git add -A on branch"""
+        clone = os.path.join(self.tmp_dir, 'clone')
+        subprocess.check_call(['git', 'clone', '-q', '-b', branch,
+                               self.repo_path, clone])
+        shutil.rmtree(os.path.join(clone, 'plugin.a'))
+        make_files(os.path.join(clone, 'plugin.a'), NEW_FILES)
+        subprocess.check_call(['git', 'add', '-A'], cwd=clone)
+        return subprocess.check_output(['git', 'write-tree'], cwd=clone).strip()
+
+    def test_diff_dir(self):
+        changed, removed = self.repo.diff_dir('HEAD', 'plugin.a',
+                                              self.make_source('source'))
+        self.assertEqual(sorted(repo_path for _, _, _, repo_path in changed), [
+            'plugin.a/added_link', 'plugin.a/addon.xml',
+            'plugin.a/from_exec.sh', 'plugin.a/link_to_file',
+            'plugin.a/modified.py', 'plugin.a/resources/lib/added.py',
+            'plugin.a/resources/lib/module.py', 'plugin.a/retargeted_link',
+            'plugin.a/to_exec.sh'])
+        self.assertEqual(removed, ['plugin.a/empty_dir/removed.txt',
+                                   'plugin.a/removed.py'])
+
+    def test_update_dir(self):
+        self.repo.update_dir('plugin.a', self.make_source('source'))
+        self.assertEqual(self.git('write-tree'), self.get_expected_tree(
+            self.git('rev-parse --abbrev-ref HEAD')))
+        # The working tree matches the index (the ignored file isn't moved)
+        self.assertEqual(self.git('diff --name-only'), '')
+        self.assertEqual(self.git('ls-files --others'), '')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.repo_path, 'plugin.a', 'empty_dir')))
+
+    def test_replace_dir(self):
+        head = self.git('rev-parse HEAD')
+        builder = gitrepo.CommitBuilder(self.repo, 'frodo')
+        try:
+            builder.replace_dir('plugin.a', self.make_source('source'))
+            builder.commit('[plugin.a] updated to version 1.1')
+        finally:
+            builder.close()
+        self.assertEqual(self.git('rev-parse frodo^{tree}'),
+                         self.get_expected_tree('frodo'))
+        # The checked out branch is left untouched
+        self.assertEqual(self.git('rev-parse HEAD'), head)
+        self.assertEqual(self.git('status --porcelain'), '')
+
+    def test_replace_dir_with_other_ignore_rules(self):
+        # The rules of the branch committed apply, not the ones of the
+        # checked out branch
+        self.git('checkout -q -b other')
+        make_files(self.repo_path, {'.gitignore': '*.py\n'})
+        self.git('commit -q -a -m ignore')
+        self.test_replace_dir()
+
+
+if __name__ == '__main__':
+    unittest.main()
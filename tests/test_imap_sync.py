@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the pull requests fetched from the label of an IMAP server
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+The IMAP server is replaced by a local stand-in and the pipeline by a
+fake one committing all the pull requests but the failing ones.
+Run with: python -m unittest discover tests
+"""
+import os
+import re
+import json
+import shutil
+import tempfile
+import unittest
+from addonpr import imapmail, pullrequest
+
+
+def make_message(*addon_ids):
+    """Return the (subject, text) of a message pulling the addons"""
+    blocks = ['*addon - %s\n*version - 1.0.0\n*url - git://some.where.git\n'
+              '*revision - a241345a\n*xbmc version - frodo\n' % addon_id
+              for addon_id in addon_ids]
+    return '[Git Pull] %s' % ', '.join(addon_ids), '\n'.join(blocks)
+
+
+class FakeIMAP(object):
+    """Local IMAP stand-in of a label
+
+    Only the commands used by the mail parser are supported.
+    messages is {uid: (subject, text)}.
+    """
+
+    def __init__(self, uidvalidity, messages):
+        self.uidvalidity = uidvalidity
+        self.messages = messages
+
+    def select(self, mailbox, readonly=False):
+        return 'OK', [str(len(self.messages))]
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [str(self.uidvalidity)]
+        return code, [None]
+
+    def uid(self, command, *args):
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in self._search(args[1:]))]
+        if command == 'FETCH':
+            return 'OK', self._fetch(*args)
+        raise ValueError(command)
+
+    def _search(self, criteria):
+        uids = sorted(self.messages)
+        if criteria[0] == 'UID':
+            first = int(criteria[1].split(':')[0])
+            # n:* always includes the last message
+            return [uid for uid in uids if uid >= first] or uids[-1:]
+        return uids
+
+    def _fetch(self, uid_set, items):
+        data = []
+        for seq, uid in enumerate(sorted(self.messages), 1):
+            if str(uid) not in uid_set.split(','):
+                continue
+            subject, text = self.messages[uid]
+            if 'BODYSTRUCTURE' in items:
+                header = 'Subject: %s\r\n\r\n' % subject
+                data.append((
+                    '%d (UID %d BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" '
+                    '"us-ascii") NIL NIL "7BIT" %d %d) '
+                    'BODY[HEADER.FIELDS (SUBJECT)] {%d}' % (
+                        seq, uid, len(text), text.count('\n'), len(header)),
+                    header))
+            else:
+                part = re.search(r'BODY\.PEEK\[(.*)\]', items).group(1)
+                data.append(('%d (UID %d BODY[%s] {%d}' % (
+                    seq, uid, part, len(text)), text))
+            data.append(')')
+        return data
+
+    def close(self):
+        pass
+
+    def logout(self):
+        pass
+
+
+class SyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'state')
+        self.conf = os.path.join(self.tmp_dir, 'conf')
+        with open(self.conf, 'w') as f:
+            f.write('[mail]\nserver = localhost\nport = 143\n'
+                    'username = user\npassword = secret\n'
+                    'label = pull_request\nstate_file = %s\n'
+                    '[cache]\nmax_size = 0\n' % self.state_file)
+        self.server = FakeIMAP(1, {})
+        # Addons of the pull requests offered to the pipeline at each run
+        self.offered = []
+        self.failing = set()
+        self._connect = imapmail.connect
+        self._run = pullrequest.Pipeline.run
+        imapmail.connect = lambda mail: self.server
+        pullrequest.Pipeline.run = lambda pipeline, prs: self._run_pipeline(prs)
+
+    def tearDown(self):
+        imapmail.connect = self._connect
+        pullrequest.Pipeline.run = self._run
+        shutil.rmtree(self.tmp_dir)
+
+    def _run_pipeline(self, pull_requests):
+        self.offered.append([pr['addon_id'] for pr in pull_requests])
+        return [index for index, pr in enumerate(pull_requests)
+                if pr['addon_id'] not in self.failing]
+
+    def process(self, resync=False):
+        """Process the pull requests of the label and return their addons"""
+        pullrequest.Parser(self.conf, resync=resync).process()
+        return self.offered.pop()
+
+    def test_new_messages(self):
+        self.server.messages = {1: make_message('plugin.a'),
+                                2: make_message('plugin.b')}
+        self.assertEqual(self.process(), ['plugin.a', 'plugin.b'])
+        self.assertEqual(self.process(), [])
+        self.server.messages[3] = make_message('plugin.c')
+        self.assertEqual(self.process(), ['plugin.c'])
+        self.assertEqual(self.process(resync=True),
+                         ['plugin.a', 'plugin.b', 'plugin.c'])
+
+    def test_failed_pull_requests(self):
+        self.server.messages = {1: make_message('plugin.a'),
+                                2: make_message('plugin.b', 'plugin.c'),
+                                3: make_message('plugin.d')}
+        self.failing = set(['plugin.c'])
+        self.assertEqual(self.process(),
+                         ['plugin.a', 'plugin.b', 'plugin.c', 'plugin.d'])
+        # Only the pull request not committed of the message is offered
+        self.server.messages[4] = make_message('plugin.e')
+        self.assertEqual(self.process(), ['plugin.c', 'plugin.e'])
+        self.failing = set()
+        self.assertEqual(self.process(), ['plugin.c'])
+        self.assertEqual(self.process(), [])
+
+    def test_uidvalidity_reset(self):
+        self.server.messages = {1: make_message('plugin.a'),
+                                2: make_message('plugin.b')}
+        self.failing = set(['plugin.b'])
+        self.assertEqual(self.process(), ['plugin.a', 'plugin.b'])
+        # The uids of the previous UIDVALIDITY are not valid anymore:
+        # all the messages are fetched again
+        self.server = FakeIMAP(2, {10: make_message('plugin.b'),
+                                   11: make_message('plugin.c')})
+        self.failing = set()
+        self.assertEqual(self.process(), ['plugin.b', 'plugin.c'])
+        self.assertEqual(self.process(), [])
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), {'pull_request': [2, 11, []]})
+
+
+if __name__ == '__main__':
+    unittest.main()
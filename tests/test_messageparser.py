@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the parser of the addon blocks of the pull request messages
+
+       Copyright (C) 2012-2013 Team XBMC
+       http://www.xbmc.org
+
+   This Program is free software; you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation; either version 2, or (at your option)
+   any later version.
+
+   This Program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program; see the file LICENSE.  If not, see
+   <http://www.gnu.org/licenses/>.
+
+messageparser.find_addon_blocks shall return the same blocks as
+ADDON_RE.findall (the regex previously used to parse the messages). Both
+are compared on a corpus of generated messages (well formed, with typical
+mistakes and random mutations). The parser time shall grow linearly on
+adversarial messages.
+Run with: python -m unittest discover tests
+"""
+import re
+import time
+import random
+import unittest
+from addonpr.messageparser import find_addon_blocks
+
+
+# Reference of the parser (it backtracks heavily on malformed messages)
+ADDON_RE = re.compile(r"""
+    ^[\s\*]*addon[\s:=\-–]*([\w\.\-]+)\s*
+    ^[\s\*]*version[\s:=\-–]*([\d\.]+)\s*
+    ^[\s\*]*url[\s:=\-–]*([\w\.@:\/\-]+)\s*
+    (?:^[\s\*]*(?:revision|tag)[\s:=\-–]*([\w\.\-]+)\s*)?
+    (?:[\s\*]*branch[\s:=\-–]*.*?\s*)?
+    ^[\s\*]*xbmc\s+version[\s:=\-–]*([\w\,\/\ ]+)
+    """, re.VERBOSE | re.MULTILINE)
+
+FIELDS = [('addon', ['plugin.video.m6groupe', 'script.foo-bar', '-', '']),
+          ('version', ['1.0.2', '2', 'v1.0', '']),
+          ('url', ['git://github.com/beenje/plugin.video.m6groupe.git',
+                   'https://bitbucket.org/foo/bar', 'git@github.com:foo/bar', '']),
+          ('revision', ['v1.0.2', 'a241345a', '']),
+          ('tag', ['1.0.2', '']),
+          ('branch', ['master', 'some branch', '']),
+          ('xbmc version', ['frodo', 'eden, frodo', 'eden and frodo', 'Frodo/Gotham',
+                            '(frodo)', ''])]
+OPTIONAL_FIELDS = ('revision', 'tag', 'branch')
+# Typical values first (they are picked more often)
+PREFIXES = [''] * 4 + ['*', '    *', ' ', ' * ', '\n', '> ', '\t']
+SEPARATORS = [': '] * 4 + [' - ', ':', ' = ', ' \xe2\x80\x93 ', ' ', ':\n', ': -', '']
+ENDS = ['\n'] * 6 + ['\r\n', ' \n', '\n\n', '\n*\n', '*\n', ' ', '']
+TOKENS = ['addon', 'version', 'url', 'revision', 'tag', 'branch', 'xbmc',
+          ' ', '\n', '\n\n', '*', ':', '=', '-', '\xe2\x80\x93', '\t', 'frodo',
+          'plugin.video.foo', '1.0.2', 'git://github.com/a/b.git', '>', '(', ',']
+BLOCK_START = 'addon: plugin.video.foo\nversion: 1.0\nurl: git://github.com/foo/bar.git\n'
+
+
+def generate_block(rand):
+    block = []
+    for name, values in FIELDS:
+        if name in OPTIONAL_FIELDS and rand.random() < 0.5:
+            continue
+        if rand.random() < 0.05:
+            continue
+        block.append(rand.choice(PREFIXES) + name + rand.choice(SEPARATORS) +
+                     rand.choice(values) + rand.choice(ENDS))
+    return ''.join(block)
+
+
+def generate_message(rand):
+    """Return a message of 1 to 3 blocks, mutated one time in two"""
+    message = ''.join(rand.choice(['Hi,\n', '', 'Thanks\n']) + generate_block(rand)
+                      for i in range(rand.randint(1, 3)))
+    if rand.random() < 0.5:
+        return message
+    chars = list(message)
+    for i in range(rand.randint(1, 5)):
+        pos = rand.randrange(len(chars) + 1)
+        if chars and rand.random() < 0.4:
+            del chars[min(pos, len(chars) - 1)]
+        else:
+            chars.insert(pos, rand.choice(TOKENS))
+    return ''.join(chars)
+
+
+def timed(message, repeat=3):
+    """Return the best time of find_addon_blocks on message"""
+    durations = []
+    for i in range(repeat):
+        start = time.time()
+        find_addon_blocks(message)
+        durations.append(time.time() - start)
+    return min(durations)
+
+
+class MessageParserTestCase(unittest.TestCase):
+
+    def test_corpus(self):
+        rand = random.Random(0)
+        for i in xrange(5000):
+            message = generate_message(rand)
+            self.assertEqual(find_addon_blocks(message),
+                             ADDON_RE.findall(message), repr(message))
+
+    def test_blocks(self):
+        message = ('Hi,\n\n*addon - plugin.video.foo\n*version - 1.0.2\n'
+                   '*url - git://github.com/foo/bar.git\n*revision - v1.0.2\n'
+                   '*branch - master\n*xbmc version - eden, frodo\n\n'
+                   'addon: script.bar\nversion: 2\nurl: https://b.org/bar\n'
+                   'xbmc version: gotham\nThanks\n')
+        self.assertEqual(find_addon_blocks(message), [
+            ('plugin.video.foo', '1.0.2', 'git://github.com/foo/bar.git',
+             'v1.0.2', 'eden, frodo'),
+            ('script.bar', '2', 'https://b.org/bar', '', 'gotham')])
+
+    def assertLinear(self, make_message, size):
+        """Check that the time on a 4 times bigger message is not 16 times
+        longer (allowing for the timer noise)
+        """
+        small = timed(make_message(size))
+        big = timed(make_message(4 * size))
+        self.assertLess(big, 8 * small + 0.01,
+                        '%.3fs then %.3fs' % (small, big))
+
+    def test_blank_lines_between_fields(self):
+        self.assertLinear(lambda count: '\n' * count + ('\n' * count).join(
+            ['addon: plugin.video.foo', 'version: 1.0',
+             'url: git://github.com/foo/bar.git', 'branch: master',
+             'xbmc: frodo\n']), 20000)
+
+    def test_dashes(self):
+        self.assertLinear(lambda size: 'addon:%s\nversion:%s\nurl:%s\n' % (
+            '-' * size, '-' * size, '-' * size), 20000)
+
+    def test_incomplete_blocks(self):
+        self.assertLinear(lambda count: 'addon: foo\n\nversion: 1\n\n\n' * count,
+                          1000)
+
+    def test_line_ends_after_branch(self):
+        self.assertLinear(lambda count: BLOCK_START + 'branch:%s%s' % (
+            '-' * 2 * count, ' \n' * count), 2000)
+
+    def test_branch_keywords_after_revision(self):
+        # Each branch keyword is reached by an end of the revision value
+        # (the separators of the revision continue on the next line): the
+        # rest of the message shall not be scanned again for each of them
+        self.assertLinear(lambda count: BLOCK_START + 'revision:%s\n%s%s' % (
+            '-' * count, 'branch' * count, '#' * 500 * count), 500)
+        self.assertLinear(lambda count: BLOCK_START + 'revision:%s\n%s\n%s' % (
+            '-' * count, 'branch' * count, ' ' * 50 * count), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()